@@ -3,11 +3,14 @@ import datetime
 import dataiku
 from dataiku.customrecipe import get_input_names_for_role, get_output_names_for_role, get_recipe_config
 from googlesheets import GoogleSheetsSession
+from dku_googledrive.session import GoogleDriveSession
 from gspread.utils import rowcol_to_a1
 from safe_logger import SafeLogger
 from googlesheets_common import DSSConstants, extract_credentials, get_tab_ids, assert_not_forbidden_dataset_type
-from time import sleep
-from googlesheets_append import append_rows
+from googlesheets_write import (
+    AppendBlockWriter, SyncBlockWriter, UpsertBlockWriter, StagedOverwriteWriter, BulkOverwriteBlockWriter,
+    DriveImportOverwriteWriter, get_overwrite_block_writer_class
+)
 
 
 logger = SafeLogger("googlesheets plugin", ["credentials", "access_token"])
@@ -41,16 +44,17 @@ if not tabs_ids:
 tab_id = tabs_ids[0]
 insert_format = config.get("insert_format")
 write_mode = config.get("write_mode", "append")
+staged_overwrite = config.get("staged_overwrite", False)
+write_engine = config.get("write_engine", "values")
 session = GoogleSheetsSession(credentials, credentials_type)
 
-batch_size = config.get("batch_size", 200)
+batch_size = config.get("batch_size", 10000)
+batch_target_size = config.get("batch_target_size") or DSSConstants.APPEND_TARGET_SIZE_KB
 insertion_delay = config.get("insertion_delay", 0)
 
 # Load worksheet
 worksheet = session.get_spreadsheet(doc_id, tab_id)
 
-worksheet.append_rows = append_rows.__get__(worksheet, worksheet.__class__)
-
 
 # Handle datetimes serialization
 def serializer_iso(obj):
@@ -75,27 +79,37 @@ writer = output_dataset.get_writer()
 
 
 # Iteration row by row
-batch = []
-if write_mode == "overwrite":
-    worksheet.clear()
-    columns = [column["name"] for column in input_schema]
-    batch.append(columns)
+columns = [column["name"] for column in input_schema]
+if write_mode == "sync":
+    sheet_writer = SyncBlockWriter(session, worksheet, insert_format, len(columns))
+elif write_mode == "upsert":
+    sheet_writer = UpsertBlockWriter(session, worksheet, insert_format, columns, config.get("key_columns", []))
+elif write_mode == "overwrite" and write_engine == "drive":
+    sheet_writer = DriveImportOverwriteWriter(session, GoogleDriveSession(config, {}), worksheet, insert_format)
+elif write_mode == "overwrite" and staged_overwrite:
+    sheet_writer = StagedOverwriteWriter(
+        session, worksheet, insert_format, len(columns), block_writer_class=get_overwrite_block_writer_class(write_engine)
+    )
+elif write_mode == "overwrite" and write_engine == "bulk":
+    sheet_writer = BulkOverwriteBlockWriter(session, worksheet, insert_format, len(columns))
+else:
+    if write_mode == "overwrite":
+        worksheet.clear()
+    sheet_writer = AppendBlockWriter(
+        worksheet, insert_format, block_size=batch_size, insertion_delay=insertion_delay, target_size_kb=batch_target_size,
+        background=True
+    )
+if write_mode in ["overwrite", "sync"]:
+    sheet_writer.write_row(columns)
 for row in input_dataset.iter_rows():
 
     # write to spreadsheet by batch
-    batch.append([serializer(v) for k, v in list(row.items())])
-
-    if len(batch) >= batch_size:
-        if insertion_delay > 0:
-            sleep(0.01 * insertion_delay)
-        worksheet.append_rows(batch, insert_format)
-        batch = []
+    sheet_writer.write_row([serializer(v) for k, v in list(row.items())])
 
     # write to output dataset
     writer.write_row_dict(row)
 
-if len(batch) > 0:
-    worksheet.append_rows(batch, insert_format)
+sheet_writer.close()
 
 # Close writer
 writer.close()
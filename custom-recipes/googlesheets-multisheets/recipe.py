@@ -5,8 +5,10 @@ from dataiku.customrecipe import get_recipe_config, get_input_names_for_role
 from googlesheets import GoogleSheetsSession
 from safe_logger import SafeLogger
 from googlesheets_common import DSSConstants, extract_credentials
-from time import sleep
-from googlesheets_append import append_rows
+from googlesheets_write import MultiSheetBlockWriter
+from collections import OrderedDict
+from googlesheets_concurrency import get_workers_count
+from concurrent.futures import ThreadPoolExecutor
 
 
 logger = SafeLogger("googlesheets plugin", ["credentials", "access_token"])
@@ -55,60 +57,96 @@ session = GoogleSheetsSession(credentials, credentials_type)
 
 insert_format = config.get("insert_format", "USER_ENTERED")
 write_mode = config.get("write_mode", "append")
-batch_size = config.get("batch_size", 200)
+batch_size = config.get("batch_size", 10000)
+batch_target_size = config.get("batch_target_size") or DSSConstants.APPEND_TARGET_SIZE_KB
 insertion_delay = config.get("insertion_delay", 0)
+workers = config.get("workers", 1)
 
 tabs_mapping = config.get("tabs_mapping", [])
 
 input_datasets_names = get_input_names_for_role('input_role')
 
-for input_dataset_name in input_datasets_names:
-    input_name = input_dataset_name
+
+def get_tab_id(input_dataset_name):
     tab_id = fetch_mapped_sheet_name(input_dataset_name)
     if tab_id is None:
         tab_id = input_dataset_name.split(".")[-1]
-    input_dataset = dataiku.Dataset(input_name)
-    input_schema = input_dataset.read_schema()
     if not tab_id:
         raise ValueError("The sheet name is not provided")
-
-    # Load worksheet
-    worksheet = session.get_spreadsheet(doc_id, tab_id)
-
-    worksheet.append_rows = append_rows.__get__(worksheet, worksheet.__class__)
-
-    # Handle datetimes serialization
-    def serializer_iso(obj):
-        if isinstance(obj, datetime.datetime):
-            return obj.isoformat()
-        return obj
-
-    def serializer_dss(obj):
-        if isinstance(obj, datetime.datetime):
-            return obj.strftime(DSSConstants.GSPREAD_DATE_FORMAT)
-        return obj
-
-    if insert_format == "USER_ENTERED":
-        serializer = serializer_dss
-    else:
-        serializer = serializer_iso
+    return tab_id
+
+
+# Handle datetimes serialization
+def serializer_iso(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    return obj
+
+
+def serializer_dss(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.strftime(DSSConstants.GSPREAD_DATE_FORMAT)
+    return obj
+
+
+if insert_format == "USER_ENTERED":
+    serializer = serializer_dss
+else:
+    serializer = serializer_iso
+
+# The whole run is planned up front: the document is opened once, the missing sheets are created
+# in one call, the overwritten sheets are cleared in one call, and the rows of all the sheets are packed
+# in shared calls
+worksheets = session.get_or_add_worksheets(doc_id, [get_tab_id(name) for name in input_datasets_names])
+unique_worksheets = list(OrderedDict((worksheet.id, worksheet) for worksheet in worksheets).values())
+spreadsheet = worksheets[0].spreadsheet
+if write_mode == "overwrite":
+    session.clear_worksheets_values(spreadsheet, unique_worksheets)
+    first_rows = dict((worksheet.id, 1) for worksheet in unique_worksheets)
+else:
+    last_data_rows = session.get_last_data_rows(unique_worksheets)
+    first_rows = dict((worksheet.id, last_data_row + 1) for worksheet, last_data_row in zip(unique_worksheets, last_data_rows))
+sheet_writer = MultiSheetBlockWriter(
+    session, spreadsheet, insert_format, first_rows,
+    block_size=batch_size, insertion_delay=insertion_delay, target_size_kb=batch_target_size
+)
+
+
+def export_dataset(input_dataset_name, worksheet):
+    input_dataset = dataiku.Dataset(input_dataset_name)
+    input_schema = input_dataset.read_schema()
 
     # Iteration row by row
-    batch = []
     if write_mode == "overwrite":
-        worksheet.clear()
         columns = [column["name"] for column in input_schema]
-        batch.append(columns)
+        sheet_writer.write_row(worksheet, columns)
     for row in input_dataset.iter_rows():
 
         # write to spreadsheet by batch
-        batch.append([serializer(v) for k, v in list(row.items())])
-
-        if len(batch) >= batch_size:
-            if insertion_delay > 0:
-                sleep(0.01 * insertion_delay)
-            worksheet.append_rows(batch, insert_format)
-            batch = []
-
-    if len(batch) > 0:
-        worksheet.append_rows(batch, insert_format)
+        sheet_writer.write_row(worksheet, [serializer(v) for k, v in list(row.items())])
+
+
+def export_datasets(worksheet, input_datasets_names):
+    # The datasets of a sheet are exported one after the other, so that their rows do not interleave
+    for input_dataset_name in input_datasets_names:
+        export_dataset(input_dataset_name, worksheet)
+
+
+worksheets_datasets_names = OrderedDict()
+for input_dataset_name, worksheet in zip(input_datasets_names, worksheets):
+    worksheets_datasets_names.setdefault(worksheet.id, []).append(input_dataset_name)
+if write_mode == "overwrite":
+    # Each dataset used to overwrite the sheet in turn, so only the last one mapped to a sheet is kept
+    for worksheet_id, worksheet_datasets_names in worksheets_datasets_names.items():
+        if len(worksheet_datasets_names) > 1:
+            logger.warning("Datasets {} are mapped to the same sheet, only {} is written".format(
+                worksheet_datasets_names[:-1], worksheet_datasets_names[-1]
+            ))
+            worksheets_datasets_names[worksheet_id] = worksheet_datasets_names[-1:]
+
+# Sheets are exported in parallel, their rows are packed by the shared writer
+datasets_names_by_worksheet = [worksheets_datasets_names[worksheet.id] for worksheet in unique_worksheets]
+with ThreadPoolExecutor(max_workers=get_workers_count(workers)) as executor:
+    for _ in executor.map(export_datasets, unique_worksheets, datasets_names_by_worksheet):
+        pass
+sheet_writer.close()
@@ -1,12 +1,21 @@
 from dataiku.connector import Connector, CustomDatasetWriter
 import json
+from itertools import chain, count, islice, repeat
+from functools import partial
 from collections import OrderedDict
-from gspread.utils import rowcol_to_a1
-from slugify import slugify
 from googlesheets import GoogleSheetsSession
+from dku_googledrive.session import GoogleDriveSession
 from safe_logger import SafeLogger
-from googlesheets_common import DSSConstants, extract_credentials, get_tab_ids, mark_date_columns, convert_dates_in_row
-from googlesheets_append import append_rows
+from googlesheets_common import (
+    DSSConstants, UniqueNameAllocator, extract_credentials, get_tab_ids, mark_date_columns, convert_dates_in_row, pad_row,
+    peek_rows_width, get_column_type
+)
+from googlesheets_write import (
+    AppendBlockWriter, SyncBlockWriter, UpsertBlockWriter, StagedOverwriteWriter, DriveImportOverwriteWriter,
+    get_overwrite_block_writer_class
+)
+from googlesheets_cache import ReadCache
+from googlesheets_export import DriveExportReader, ExportTooLargeError, is_exported_as_xlsx
 
 
 logger = SafeLogger("googlesheets plugin", ["credentials", "access_token"])
@@ -23,27 +32,58 @@ class MyConnector(Connector):
         self.tabs_ids = get_tab_ids(config)
         self.result_format = self.config.get("result_format")
         self.write_format = self.config.get("write_format")
-        self.list_unique_slugs = []
+        self.overwrite_strategy = self.config.get("overwrite_strategy", "full")
+        self.write_engine = self.config.get("write_engine", "values")
+        self.upsert_key_columns = [
+            column.strip() for column in (self.config.get("upsert_key_columns") or "").split(",") if column.strip()
+        ]
         self.add_sheet_name_column = self.config.get("add_sheet_name_column", False)
-
-    def get_unique_slug(self, string):
-        string = slugify(string, max_length=25, separator="_", lowercase=False)
-        if string == '':
-            string = 'none'
-        test_string = string
-        i = 0
-        while test_string in self.list_unique_slugs:
-            i += 1
-            test_string = string + '_' + str(i)
-        self.list_unique_slugs.append(test_string)
-        return test_string
+        self.read_window_size = self.config.get("read_window_size") or DSSConstants.READ_WINDOW_SIZE
+        self.read_workers = self.config.get("read_workers", 1)
+        self.read_cache = None
+        if self.config.get("use_read_cache", False):
+            self.read_cache = ReadCache(self.config.get("read_cache_max_size") or DSSConstants.READ_CACHE_MAX_SIZE)
+        self.infer_schema = self.config.get("infer_schema", False)
+        self.read_engine = self.config.get("read_engine", "values")
 
     def get_read_schema(self):
         # The Google Spreadsheets connector does not have a fixed schema, since each
         # sheet has its own (varying) schema.
         #
-        # Better let DSS handle this
-        return None
+        # Better let DSS handle this, unless the schema inference is activated
+        if not self.infer_schema:
+            return None
+        schema_cache = self.read_cache or ReadCache(DSSConstants.READ_CACHE_MAX_SIZE)
+        schema_key = [self.doc_id, self.tabs_ids, self.result_format, self.add_sheet_name_column]
+        last_modified = self.session.get_last_modified(self.doc_id)
+        schema = schema_cache.get_schema(schema_key, last_modified)
+        if schema is None:
+            schema = self.infer_read_schema()
+            schema_cache.set_schema(schema_key, last_modified, schema)
+        return schema
+
+    def infer_read_schema(self):
+        """
+        Infers the type of each column from a sample of the first rows of each selected sheet
+        """
+        header_rows = 1 if self.result_format == 'first-row-header' else 0
+        max_rows = header_rows + DSSConstants.SCHEMA_INFERENCE_SAMPLE_SIZE
+        columns_values = OrderedDict()
+        for worksheet, rows, used_width in self.iter_worksheets_rows(self.get_selected_worksheets(), max_rows=max_rows):
+            for record in self.generate_worksheet_records(worksheet, rows, used_width):
+                for column_name, value in record.items():
+                    columns_values.setdefault("{}".format(column_name), []).append(value)
+        columns = []
+        for column_name, values in columns_values.items():
+            columns.append({"name": column_name, "type": get_column_type(values)})
+        logger.info("Inferred schema: {}".format(columns))
+        return {"columns": columns}
+
+    def get_selected_worksheets(self):
+        worksheets = self.session.get_spreadsheets(self.doc_id)
+        if self.tabs_ids:
+            worksheets = [worksheet for worksheet in worksheets if worksheet.title in self.tabs_ids]
+        return worksheets
 
     def generate_rows(self, dataset_schema=None, dataset_partitioning=None,
                       partition_id=None, records_limit=-1):
@@ -55,44 +95,130 @@ class MyConnector(Connector):
 
         The dataset schema and partitioning are given for information purpose.
         """
-        worksheets = self.session.get_spreadsheets(self.doc_id)
-
-        for worksheet in worksheets:
-            if self.tabs_ids and (worksheet.title not in self.tabs_ids):
-                continue
-            rows = worksheet.get_all_values()
-            try:
-                columns = rows[0]
-            except IndexError:
-                columns = []
-
-            if self.add_sheet_name_column and self.result_format == 'first-row-header':
+        worksheets = self.get_selected_worksheets()
+        remaining_records = records_limit if records_limit is not None and records_limit >= 0 else None
+        header_rows = 1 if self.result_format == 'first-row-header' else 0
+
+        max_rows = None
+        if remaining_records is not None:
+            # Only request the header plus the number of records needed to reach the limit
+            max_rows = header_rows + remaining_records
+
+        for worksheet, rows, used_width in self.iter_worksheets_rows(worksheets, max_rows=max_rows):
+            if remaining_records is not None:
+                if remaining_records <= 0:
+                    return
+                rows = islice(rows, header_rows + remaining_records)
+            for record in self.generate_worksheet_records(worksheet, rows, used_width):
+                yield record
+                if remaining_records is not None:
+                    remaining_records -= 1
+
+    def generate_worksheet_records(self, worksheet, rows, used_width=None):
+        # Like get_all_values used to, rows are padded to the used width of the sheet, or when it is not known,
+        # to the widest row of the first window
+        width = used_width
+        if width is None:
+            first_rows, width, _ = peek_rows_width(rows, self.read_window_size)
+            rows = chain(first_rows, rows)
+        sheet_name = "{}".format(worksheet.title)
+        prefix = (sheet_name,) if self.add_sheet_name_column else ()
+        # Rows shorter than the widest one are completed with empty cells
+        empty_cells = repeat("")
+
+        if self.result_format == 'first-row-header':
+            header = next(rows, None)
+            if header is None:
+                return
+            columns = pad_row(list(header), width)
+            if self.add_sheet_name_column:
                 columns.insert(0, "Sheet name")
+            columns_allocator = UniqueNameAllocator(max_length=25)
+            keys = columns_allocator.allocate_all(columns)
+            allocate_key = partial(columns_allocator.allocate, "")
 
-            self.list_unique_slugs = []
-            columns_slug = list(map(self.get_unique_slug, columns))
+        elif self.result_format == 'no-header':
+            keys = list(range(1, len(prefix) + width + 1))
+            allocate_key = partial(next, count(len(prefix) + width + 1))
 
-            if self.result_format == 'first-row-header':
-                for row in rows[1:]:
-                    if self.add_sheet_name_column:
-                        row.insert(0, "{}".format(worksheet.title))
-                    yield OrderedDict(zip(columns_slug, row))
+        elif self.result_format == 'json':
+            for row in rows:
+                yield {"json": json.dumps(list(prefix) + pad_row(row, width))}
+            return
 
-            elif self.result_format == 'no-header':
-                for row in rows:
-                    if self.add_sheet_name_column:
-                        row.insert(0, "{}".format(worksheet.title))
-                    yield OrderedDict(zip(range(1, len(columns) + 1), row))
+        else:
 
-            elif self.result_format == 'json':
-                for row in rows:
-                    if self.add_sheet_name_column:
-                        row.insert(0, "{}".format(worksheet.title))
-                    yield {"json": json.dumps(row)}
+            raise Exception("Unimplemented")
 
-            else:
+        # Keys are computed once per sheet, each row only costs the creation of its record
+        for row in rows:
+            if len(row) > width:
+                # Rows wider than the first window, or than a sheet that grew while it was read, are never truncated
+                keys.extend(allocate_key() for _ in range(len(row) - width))
+                width = len(row)
+            yield dict(zip(keys, chain(prefix, row, empty_cells)))
 
-                raise Exception("Unimplemented")
+    def iter_worksheets_rows(self, worksheets, max_rows=None):
+        """
+        Yields a (worksheet, rows, used_width) tuple for each worksheet. used_width is None when the source of the rows
+        does not tell it.
+        """
+        if max_rows is not None:
+            # Previews and samples are padded to the widest row they read, which saves the probe of the used width
+            worksheets_rows = self.session.iter_worksheets_rows(
+                worksheets, window_size=self.read_window_size, max_rows=max_rows, workers=self.read_workers
+            )
+            return ((worksheet, rows, None) for worksheet, rows in worksheets_rows)
+        if self.read_cache is None:
+            return self.fetch_worksheets_rows(worksheets)
+        return self.iter_worksheets_rows_with_cache(worksheets)
+
+    def fetch_worksheets_rows(self, worksheets, as_xlsx=None):
+        if self.read_engine == "drive" and worksheets:
+            reader = DriveExportReader(GoogleDriveSession(self.config, {}), self.doc_id, worksheets, as_xlsx=as_xlsx)
+            try:
+                reader.download()
+                return reader.iter_worksheets_rows()
+            except ExportTooLargeError as error:
+                logger.warning("{}, reading it through the values API".format(error))
+        return self.iter_values_worksheets_rows(worksheets)
+
+    def iter_values_worksheets_rows(self, worksheets):
+        worksheets_rows = self.session.iter_worksheets_rows(worksheets, window_size=self.read_window_size, workers=self.read_workers)
+        for worksheet, rows in worksheets_rows:
+            # The values API trims the rows, so the used width is probed in the rows after the first window
+            first_rows, width, has_more_rows = peek_rows_width(rows, self.read_window_size)
+            if has_more_rows:
+                width = self.session.get_used_width(worksheet, width, first_row=len(first_rows) + 1)
+            yield worksheet, chain(first_rows, rows), width
+
+    def get_value_format(self, worksheets):
+        if self.read_engine == "drive":
+            # The CSV export gives formatted values, the XLSX export gives the raw ones
+            return "XLSX" if is_exported_as_xlsx(worksheets) else "CSV"
+        return "FORMATTED_VALUE"
+
+    def iter_worksheets_rows_with_cache(self, worksheets):
+        last_modified = self.session.get_last_modified(self.doc_id)
+        # The export format is chosen on all the selected tabs, so that it matches the key of the cached ones
+        value_format = self.get_value_format(worksheets)
+        cached_rows = {}
+        for worksheet in worksheets:
+            cached_entry = self.read_cache.get_rows(self.doc_id, worksheet.title, last_modified, self.read_engine, value_format)
+            if cached_entry is not None:
+                cached_rows[worksheet.title] = cached_entry
+        worksheets_to_fetch = [worksheet for worksheet in worksheets if worksheet.title not in cached_rows]
+        fetched_worksheets_rows = self.fetch_worksheets_rows(worksheets_to_fetch, as_xlsx=value_format == "XLSX")
+        for worksheet in worksheets:
+            if worksheet.title in cached_rows:
+                rows, used_width = cached_rows[worksheet.title]
+                yield worksheet, rows, used_width
+            else:
+                worksheet, rows, used_width = next(fetched_worksheets_rows)
+                rows = self.read_cache.write_rows(
+                    self.doc_id, worksheet.title, last_modified, self.read_engine, value_format, rows, used_width
+                )
+                yield worksheet, rows, used_width
 
     def get_writer(self, dataset_schema=None, dataset_partitioning=None,
                    partition_id=None, write_mode="OVERWRITE"):
@@ -112,9 +238,14 @@ class MyConnector(Connector):
         """
         Returns the count of records for the dataset (or a partition).
         """
-        # row_count currently rounds up to 1000 records
-        # For this reason, canCountRecords is set to false and this method is currently ignored by DSS
-        raise NotImplementedError("Count records")
+        # row_count is the size of the grid, which is often rounded up to 1000 rows
+        # so the last non-empty row of each sheet is probed instead
+        worksheets = self.get_selected_worksheets()
+        header_rows = 1 if self.result_format == 'first-row-header' else 0
+        records_count = 0
+        for last_data_row in self.session.get_last_data_rows(worksheets):
+            records_count += max(0, last_data_row - header_rows)
+        return records_count
 
 
 class MyCustomDatasetWriter(CustomDatasetWriter):
@@ -126,37 +257,44 @@ class MyCustomDatasetWriter(CustomDatasetWriter):
         self.dataset_partitioning = dataset_partitioning
         self.partition_id = partition_id
         self.write_mode = write_mode
-        self.buffer = []
         self.date_columns = []
         if self.parent.write_format == "USER_ENTERED":
             self.date_columns = mark_date_columns(dataset_schema)
             logger.info("Columns #{} are marked for date conversion".format(self.date_columns))
         columns = [column["name"] for column in dataset_schema["columns"]]
-        if parent.result_format == 'first-row-header':
-            self.buffer.append(columns)
+        worksheet = self.parent.session.get_spreadsheet(self.parent.doc_id, self.parent.tabs_ids[0])
+        if self.write_mode == "APPEND" and self.parent.upsert_key_columns:
+            if parent.result_format != 'first-row-header':
+                raise Exception('Rows can only be upserted in sheets with a header row')
+            self.block_writer = UpsertBlockWriter(
+                self.parent.session, worksheet, self.parent.write_format, columns, self.parent.upsert_key_columns
+            )
+        elif self.write_mode == "APPEND":
+            self.block_writer = AppendBlockWriter(worksheet, self.parent.write_format)
+        elif self.parent.overwrite_strategy == "sync":
+            self.block_writer = SyncBlockWriter(self.parent.session, worksheet, self.parent.write_format, len(columns))
+        elif self.parent.write_engine == "drive":
+            self.block_writer = DriveImportOverwriteWriter(
+                self.parent.session, GoogleDriveSession(config, {}), worksheet, self.parent.write_format
+            )
+        elif self.parent.overwrite_strategy == "staged":
+            self.block_writer = StagedOverwriteWriter(
+                self.parent.session, worksheet, self.parent.write_format, len(columns),
+                block_writer_class=get_overwrite_block_writer_class(self.parent.write_engine)
+            )
+        else:
+            block_writer_class = get_overwrite_block_writer_class(self.parent.write_engine)
+            self.block_writer = block_writer_class(self.parent.session, worksheet, self.parent.write_format, len(columns))
+        if self.write_mode != "APPEND" and parent.result_format == 'first-row-header':
+            self.block_writer.write_row(columns)
 
     def write_row(self, row):
         if self.date_columns:
             row = convert_dates_in_row(row, self.date_columns)
-        self.buffer.append(row)
+        self.block_writer.write_row(row)
 
     def flush(self):
-        worksheet = self.parent.session.get_spreadsheet(self.parent.doc_id, self.parent.tabs_ids[0])
-        worksheet.append_rows = append_rows.__get__(worksheet, worksheet.__class__)
-
-        if self.write_mode == "APPEND":
-            worksheet.append_rows(self.buffer[1:], self.parent.write_format) #TODO: batch ?
-        elif self.write_mode == "OVERWRITE":
-            num_columns = len(self.buffer[0])
-            num_lines = len(self.buffer)
-
-            worksheet.resize(rows=num_lines, cols=num_columns)
-
-            range = 'A1:%s' % rowcol_to_a1(num_lines, num_columns)
-            worksheet.update(range, self.buffer, value_input_option=self.parent.write_format)
-
-        self.buffer = []
+        self.block_writer.flush()
 
     def close(self):
-        self.flush()
-        pass
+        self.block_writer.close()
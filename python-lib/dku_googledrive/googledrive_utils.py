@@ -29,6 +29,8 @@ class GoogleDriveUtils(object):
     GOOGLE_APPS = "google-apps"
     BINARY_STREAM = "binary/octet-stream"
     LIST_FIELDS = "nextPageToken, files(id, name, size, parents, mimeType, createdTime, modifiedTime)"
+    CHANGES_FIELDS = "nextPageToken, newStartPageToken, changes(fileId, removed, file(mimeType, parents, trashed))"
+    CHANGES_PAGE_SIZE = 1000
     GOOGLE_DOC_MIME_EQUIVALENCE = {
         SPREADSHEET: CSV,
         GOOGLE_DOCUMENT: "text/plain",
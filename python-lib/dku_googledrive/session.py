@@ -1,8 +1,6 @@
 import logging
-import shutil
 import os
 import json
-from random import randrange
 
 from apiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
@@ -12,19 +10,18 @@ from mimetypes import MimeTypes
 from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
 from googleapiclient.errors import HttpError
 from dku_googledrive.googledrive_utils import GoogleDriveUtils as gdu
-from time import sleep
 from dku_googledrive.memory_cache import MemoryCache
-
-try:
-    from BytesIO import BytesIO  # for Python 2
-except ImportError:
-    from io import BytesIO  # for Python 3
+from googlesheets_quota import get_quota_scheduler, DRIVE, RETRYABLE_STATUSES
+from googlesheets_common import get_service_account_credentials
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO,
                     format='googledrive plugin %(levelname)s - %(message)s')
 
 
+DRIVE_RETRYABLE_STATUSES = [403] + RETRYABLE_STATUSES
+
+
 class GoogleDriveSessionError(ValueError):
     pass
 
@@ -47,6 +44,10 @@ class GoogleDriveSession():
             self.access_token = config.get("oauth_credentials")["access_token"]
             credentials = AccessTokenCredentials(self.access_token, "dss-googledrive-plugin/2.0")
             http_auth = credentials.authorize(Http())
+        elif self.auth_type in [None, "legacy-service-account"]:
+            credentials_dict = get_service_account_credentials(config.get("credentials", ""))
+            credentials = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, scopes)
+            http_auth = credentials.authorize(Http())
         else:
             credentials_dict = eval(config.get("preset_credentials_service_account", {}).get("credentials", ""))
             credentials = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, scopes)
@@ -55,6 +56,7 @@ class GoogleDriveSession():
         if not self.root_id:
             self.root_id = gdu.ROOT_ID
         self.max_attempts = 5
+        self.scheduler = get_quota_scheduler()
         self.root_id = gdu.get_root_id(config)
         self.drive = build(
             gdu.API,
@@ -92,6 +94,7 @@ class GoogleDriveSession():
     def get_last_modified_by_file_id(self, file_id):
         last_modified = None
         logger.info("get_last_modified_by_file_id {}".format(file_id))
+        self.scheduler.acquire(DRIVE)
         try:
             last_modified = self.drive.files().get(fileId=file_id, fields="modifiedTime").execute().get("modifiedTime")
             #  GET https://www.googleapis.com/drive/v3/files/<<file_id>>?fields=modifiedTime&alt=json
@@ -104,26 +107,67 @@ class GoogleDriveSession():
             raise Exception(error_message)
         return last_modified
 
+    def get_changes_start_page_token(self):
+        attempts = 0
+        while attempts < self.max_attempts:
+            self.scheduler.acquire(DRIVE)
+            try:
+                response = self.drive.changes().getStartPageToken(supportsAllDrives=True).execute()
+                return response.get("startPageToken")
+            except HttpError as err:
+                self.handle_googledrive_errors(err, "changes start page token", attempts)
+            attempts = attempts + 1
+            logger.info('get_changes_start_page_token:attempts={}'.format(attempts))
+        raise GoogleDriveSessionError("Max number of attempts reached in Google Drive changes start page token operation")
+
+    def list_changes(self, page_token):
+        """
+        Returns the changes made in the Drive since page_token, and the page token to poll the next changes from
+        """
+        changes = []
+        while page_token:
+            response = self.googledrive_list_changes_page(page_token)
+            changes.extend(response.get("changes", []))
+            if response.get("newStartPageToken"):
+                return changes, response.get("newStartPageToken")
+            page_token = response.get("nextPageToken")
+        raise GoogleDriveSessionError("Google Drive changes list returned no new start page token")
+
+    def googledrive_list_changes_page(self, page_token):
+        attempts = 0
+        while attempts < self.max_attempts:
+            self.scheduler.acquire(DRIVE)
+            try:
+                return self.drive.changes().list(
+                    pageToken=page_token,
+                    pageSize=gdu.CHANGES_PAGE_SIZE,
+                    fields=gdu.CHANGES_FIELDS,
+                    includeItemsFromAllDrives=True,
+                    supportsAllDrives=True
+                ).execute()
+            except HttpError as err:
+                self.handle_googledrive_errors(err, "changes list", attempts)
+            attempts = attempts + 1
+            logger.info('googledrive_list_changes_page:attempts={} on {}'.format(attempts, page_token))
+        raise GoogleDriveSessionError("Max number of attempts reached in Google Drive changes list operation")
+
     def googledrive_download(self, item, stream):
+        self.scheduler.acquire(DRIVE)
         if gdu.is_file_google_doc(item):
             document_type = gdu.get_google_doc_type(item)
-            data = self.drive.files().export_media(
+            request = self.drive.files().export_media(
                 fileId=gdu.get_id(item),
                 mimeType=gdu.get_google_doc_mime_equivalence(
                     document_type,
                     self.output_google_sheets_as_xlsx
                 )
-            ).execute()
-            file_handle = BytesIO()
-            file_handle.write(data)
-            file_handle.seek(0)
-            shutil.copyfileobj(file_handle, stream)
+            )
         else:
             request = self.drive.files().get_media(fileId=gdu.get_id(item))
-            downloader = MediaIoBaseDownload(stream, request, chunksize=1024*1024)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
+        downloader = MediaIoBaseDownload(stream, request, chunksize=1024*1024)
+        done = False
+        while done is False:
+            status, done = downloader.next_chunk()
 
     def directory(self, item, root_path=None):
         query = gdu.query_parents_in([gdu.get_id(item)], trashed=False)
@@ -133,6 +177,7 @@ class GoogleDriveSession():
     def googledrive_list(self, query):
         attempts = 0
         while attempts < self.max_attempts:
+            self.scheduler.acquire(DRIVE)
             try:
                 files = []
                 kwargs = {
@@ -152,7 +197,7 @@ class GoogleDriveSession():
                     next_page_token = response.get('nextPageToken')
                 return files
             except HttpError as err:
-                self.handle_googledrive_errors(err, "list")
+                self.handle_googledrive_errors(err, "list", attempts)
             attempts = attempts + 1
             logger.info('googledrive_list:attempts={} on {}'.format(attempts, query))
         raise GoogleDriveSessionError("Max number of attempts reached in Google Drive directory list operation")
@@ -189,6 +234,7 @@ class GoogleDriveSession():
                 body[gdu.PARENTS] = [parent_id]
 
         while attempts < self.max_attempts:
+            self.scheduler.acquire(DRIVE)
             try:
                 file = self.drive.files().create(
                     body=body,
@@ -198,7 +244,7 @@ class GoogleDriveSession():
                 ).execute()
                 return file
             except HttpError as err:
-                self.handle_googledrive_errors(err, "create")
+                self.handle_googledrive_errors(err, "create", attempts)
             attempts = attempts + 1
             logger.info('googledrive_create:attempts={} on {}'.format(attempts, body))
         raise GoogleDriveSessionError("Max number of attempts reached in Google Drive directory create operation")
@@ -228,13 +274,13 @@ class GoogleDriveSession():
         files = self.googledrive_list(query)
 
         if len(files) == 0:
-            self.googledrive_create(
+            return self.googledrive_create(
                 body=file_metadata,
                 media_body=media,
                 parent_id=parent_id
             )
         else:
-            self.googledrive_update(
+            return self.googledrive_update(
                 file_id=gdu.get_id(files[0]),
                 body=file_metadata,
                 media_body=media,
@@ -244,6 +290,7 @@ class GoogleDriveSession():
     def googledrive_update(self, file_id, body, media_body=None, parent_id=None):
         attempts = 0
         while attempts < self.max_attempts:
+            self.scheduler.acquire(DRIVE)
             try:
                 file = self.drive.files().update(
                     fileId=file_id,
@@ -265,7 +312,7 @@ class GoogleDriveSession():
                     logger.info("googledrive_create:googledrive_create done")
                     return file
                 else:
-                    self.handle_googledrive_errors(err, "update")
+                    self.handle_googledrive_errors(err, "update", attempts)
             attempts = attempts + 1
             logger.info('googledrive_update:attempts={} on {}'.format(attempts, body))
         raise GoogleDriveSessionError("Max number of attempts reached in Google Drive directory update operation")
@@ -273,6 +320,7 @@ class GoogleDriveSession():
     def googledrive_delete(self, item, parent_id=None):
         attempts = 0
         while attempts < self.max_attempts:
+            self.scheduler.acquire(DRIVE)
             try:
                 if len(item[gdu.PARENTS]) == 1 or parent_id is None:
                     self.drive.files().delete(
@@ -285,19 +333,19 @@ class GoogleDriveSession():
                         removeParents=parent_id,
                         supportsAllDrives=True
                     ).execute()
+                return
             except HttpError as err:
                 logger.warn("HttpError={}".format(err))
                 if err.resp.status == 404:
                     return
-                self.handle_googledrive_errors(err, "delete")
+                self.handle_googledrive_errors(err, "delete", attempts)
             attempts = attempts + 1
             logger.info('googledrive_delete:attempts={} on {}'.format(attempts, item))
         raise GoogleDriveSessionError("Max number of attempts reached in Google Drive directory delete operation")
 
-    def handle_googledrive_errors(self, err, context=""):
-        if err.resp.status in [403, 500, 503]:
-            sleep(5 + randrange(5))
-        else:
+    def handle_googledrive_errors(self, err, context="", attempt=0):
+        # Drive reports rate limits as 403 as well as 429
+        if not self.scheduler.wait_before_retry(err.resp.status, attempt, err.resp.get("retry-after"), DRIVE_RETRYABLE_STATUSES):
             reason = ""
             if err.resp.get('content-type', '').startswith('application/json'):
                 reason = json.loads(err.content).get('error').get('errors')[0].get('reason')
@@ -1,46 +1,133 @@
-import json
-import os.path
+import threading
+import uuid
 import gspread
+from gspread.models import Worksheet
+from gspread.utils import rowcol_to_a1
+from gspread.urls import SPREADSHEETS_API_V4_BASE_URL
 from oauth2client.service_account import ServiceAccountCredentials
 from oauth2client.client import AccessTokenCredentials
 from safe_logger import SafeLogger
+from functools import partial
+from googlesheets_common import DSSConstants, get_service_account_credentials
+from googlesheets_concurrency import ThreadLocalHttpSession, OrderedPrefetcher
+from googlesheets_quota import get_quota_scheduler, SHEETS_READ, SHEETS_WRITE, DRIVE, RETRYABLE_STATUSES
 
 
 logger = SafeLogger("googlesheets plugin", ["credentials", "access_token"])
 
+DRIVE_API_URL = "https://www.googleapis.com/drive/"
+DRIVE_FILES_API_V3_URL = DRIVE_API_URL + "v3/files/{}"
+SPREADSHEET_SHEET_COPY_TO_URL = SPREADSHEETS_API_V4_BASE_URL + "/{}/sheets/{}:copyTo"
+SPREADSHEET_VALUES_BATCH_CLEAR_URL = SPREADSHEETS_API_V4_BASE_URL + "/{}/values:batchClear"
+# POST calls that write to explicit ranges, which can be sent again without changing their result
+IDEMPOTENT_POST_ENDPOINTS = ("values:batchUpdate", "values:batchClear", "values:batchGet", ":clear")
+# A request rejected by the rate limiter was not applied, whereas a request that failed with a 5xx may have been
+NOT_APPLIED_STATUSES = [429]
 
-def _get_service_account_credentials(input_credentials):
+
+def is_idempotent(method, endpoint):
+    if method in ["get", "put"]:
+        return True
+    return method == "post" and endpoint.split("?")[0].endswith(IDEMPOTENT_POST_ENDPOINTS)
+
+
+class QuotaAwareClient(gspread.Client):
     """
-    Takes the input param 'credentials' that can accept a JSON token or a path to a file
-    and returns a dict.
+    gspread client whose requests are paced and retried by the quota scheduler of the process
     """
-    test_file = input_credentials.splitlines()[0]
-    if os.path.isfile(test_file):
-        try:
-            with open(test_file, 'r') as f:
-                credentials = json.load(f)
-                f.close()
-        except Exception as e:
-            raise ValueError("Unable to read the JSON Service Account from file '%s'.\n%s" % (test_file, e))
-    else:
-        try:
-            credentials = json.loads(input_credentials)
-        except Exception as e:
-            raise Exception("Unable to read the JSON Service Account.\n%s" % e)
+    def request(self, method, endpoint, params=None, data=None, json=None, files=None, headers=None):
+        scheduler = get_quota_scheduler()
+        if endpoint.startswith(DRIVE_API_URL):
+            quota = DRIVE
+        elif method == "get":
+            quota = SHEETS_READ
+        else:
+            quota = SHEETS_WRITE
+        # Appends, sheet creations and other batchUpdate requests would be applied twice if retried after a 5xx
+        retryable_statuses = RETRYABLE_STATUSES if is_idempotent(method, endpoint) else NOT_APPLIED_STATUSES
+        attempt = 0
+        while True:
+            scheduler.acquire(quota)
+            try:
+                return super(QuotaAwareClient, self).request(
+                    method, endpoint, params=params, data=data, json=json, files=files, headers=headers
+                )
+            except gspread.exceptions.APIError as error:
+                retry_after = error.response.headers.get("Retry-After")
+                if not scheduler.wait_before_retry(error.response.status_code, attempt, retry_after, retryable_statuses):
+                    raise
+            attempt += 1
+
+
+def _authorize(credentials):
+    # Same as gspread.authorize, with an HTTP session that can be used by several threads
+    client = QuotaAwareClient(auth=credentials, session=ThreadLocalHttpSession())
+    client.login()
+    return client
+
+
+def get_a1_range(worksheet_title, first_row, last_row, last_column, first_column=1):
+    """
+    Returns the A1 notation of the rows first_row to last_row of a sheet, such as 'Sheet 1'!A2:ZZ5001
+    """
+    return "'{}'!{}:{}".format(
+        worksheet_title.replace("'", "''"),
+        rowcol_to_a1(first_row, first_column),
+        rowcol_to_a1(last_row, max(last_column, first_column))
+    )
+
+
+def get_last_row_to_read(worksheet, max_rows=None):
+    if max_rows is None:
+        return worksheet.row_count
+    return min(worksheet.row_count, max_rows)
+
+
+def get_windows(last_row, window_size):
+    """
+    Returns the (first_row, last_row) bounds of the windows needed to read the first last_row rows of a worksheet
+    """
+    return [
+        (first_row, min(first_row + window_size - 1, last_row)) for first_row in range(1, last_row + 1, window_size)
+    ]
 
-    return credentials
+
+class WindowsReader(object):
+    def __init__(self, prefetcher, windows, first_window_rows):
+        self.prefetcher = prefetcher
+        self.windows = windows
+        self.first_window_rows = first_window_rows
+        self.windows_left = max(len(windows) - 1, 0)
+
+    def iter_rows(self):
+        pending_empty_rows = 0
+        for index, (first_row, last_row) in enumerate(self.windows):
+            if index == 0:
+                rows = self.first_window_rows
+            else:
+                self.windows_left -= 1
+                rows = self.prefetcher.next()
+            if rows:
+                for _ in range(pending_empty_rows):
+                    yield []
+                pending_empty_rows = 0
+                for row in rows:
+                    yield row
+            # The API does not return the empty rows at the end of the requested range
+            pending_empty_rows += last_row - first_row + 1 - len(rows)
 
 
 class GoogleSheetsSession():
     scope = [
-        'https://www.googleapis.com/auth/spreadsheets'
+        'https://www.googleapis.com/auth/spreadsheets',
+        'https://www.googleapis.com/auth/drive.metadata.readonly'
     ]
 
     def __init__(self, credentials, credentials_type="preset-service-account"):
         self.client = None
         if credentials_type == "service-account":
-            credentials = _get_service_account_credentials(credentials)
-            self.client = gspread.authorize(
+            credentials = get_service_account_credentials(credentials)
+            self.client = _authorize(
                 ServiceAccountCredentials.from_json_keyfile_dict(
                     credentials,
                     self.scope
@@ -48,10 +135,12 @@ class GoogleSheetsSession():
             )
             self.email = credentials.get("client_email", "(email missing)")
         else:
-            self.client = gspread.authorize(
+            self.client = _authorize(
                 AccessTokenCredentials(credentials, "dss-googledrive-plugin/2.0")
             )
             self.email = "(email missing)"
+        self.metadata = {}
+        self.metadata_lock = threading.Lock()
 
     def list_documents_by_title(self, document_title, folder_id=None):
         return self.client.list_spreadsheet_files(document_title, folder_id=folder_id)
@@ -62,14 +151,35 @@ class GoogleSheetsSession():
     def get_spreadsheet(self, document_id, tab_id):
         return self.get_spreadsheets(document_id, tab_id)[0]
 
+    def open_spreadsheet(self, document_id):
+        """
+        Returns the spreadsheet and its worksheets. The metadata of each document is fetched
+        once per session, until a structural change calls invalidate_metadata.
+        """
+        with self.metadata_lock:
+            if document_id not in self.metadata:
+                spreadsheet = self.client.open_by_key(document_id)
+                sheet_metadata = spreadsheet.fetch_sheet_metadata()
+                # Also sets the title, so that spreadsheet.title does not fetch the metadata again
+                spreadsheet._properties.update(sheet_metadata.get("properties", {}))
+                worksheets = [Worksheet(spreadsheet, sheet["properties"]) for sheet in sheet_metadata.get("sheets", [])]
+                self.metadata[document_id] = (spreadsheet, worksheets)
+            return self.metadata[document_id]
+
+    def invalidate_metadata(self, document_id):
+        with self.metadata_lock:
+            self.metadata.pop(document_id, None)
+
     def get_spreadsheets(self, document_id, tab_id=None):
         try:
-            # worksheet and worksheets both make a single fetch_sheet_metadata request
-            # so better use one worksheets than multiple worksheet
+            spreadsheet, worksheets = self.open_spreadsheet(document_id)
             if tab_id:
-                return [self.client.open_by_key(document_id).worksheet(tab_id)]
+                for worksheet in worksheets:
+                    if worksheet.title == tab_id:
+                        return [worksheet]
+                raise gspread.exceptions.WorksheetNotFound(tab_id)
             else:
-                return self.client.open_by_key(document_id).worksheets()
+                return list(worksheets)
         except gspread.exceptions.SpreadsheetNotFound as error:
             logger.error("{}".format(error))
             raise Exception("Trying to open non-existent or inaccessible spreadsheet document.")
@@ -77,7 +187,10 @@ class GoogleSheetsSession():
             logger.error("{}".format(error))
             logger.info("The sheet {} was not found in document {}, trying to create it now".format(tab_id, document_id))
             try:
-                return [self.client.open_by_key(document_id).add_worksheet(tab_id, 1000, 26)]
+                spreadsheet, worksheets = self.open_spreadsheet(document_id)
+                worksheet = spreadsheet.add_worksheet(tab_id, 1000, 26)
+                self.invalidate_metadata(document_id)
+                return [worksheet]
             except Exception as error:
                 logger.error("{}".format(error))
                 raise Exception("The sheet %s could not be created." % tab_id)
@@ -95,9 +208,291 @@ class GoogleSheetsSession():
                     raise Exception("This document is not a Google Sheet. Please use the Google Drive plugin instead.")
             raise Exception("The Google API returned an error: %s" % error)
 
+    def resize_worksheet(self, worksheet, rows=None, cols=None):
+        self.clear_worksheet(worksheet, rows=rows, cols=cols, clear_values=False)
+
+    def clear_worksheet(self, worksheet, rows=None, cols=None, clear_values=True):
+        """
+        Empties the values of a worksheet and / or resizes its grid, in a single batchUpdate call.
+        The grid properties of the worksheet object are kept up to date.
+        """
+        requests = []
+        if clear_values:
+            requests.append({
+                "updateCells": {
+                    "range": {"sheetId": worksheet.id},
+                    "fields": "userEnteredValue"
+                }
+            })
+        grid_properties = {}
+        if rows is not None:
+            grid_properties["rowCount"] = rows
+        if cols is not None:
+            grid_properties["columnCount"] = cols
+        if grid_properties:
+            requests.append({
+                "updateSheetProperties": {
+                    "properties": {"sheetId": worksheet.id, "gridProperties": grid_properties},
+                    "fields": ",".join("gridProperties/{}".format(key) for key in grid_properties)
+                }
+            })
+        if requests:
+            worksheet.spreadsheet.batch_update({"requests": requests})
+            worksheet._properties.setdefault("gridProperties", {}).update(grid_properties)
+
+    def resize_worksheets(self, spreadsheet, sizes):
+        """
+        Resizes the grids of several worksheets in a single batchUpdate call.
+        sizes is a list of (worksheet, rows, cols) tuples.
+        """
+        if not sizes:
+            return
+        spreadsheet.batch_update({
+            "requests": [
+                {
+                    "updateSheetProperties": {
+                        "properties": {"sheetId": worksheet.id, "gridProperties": {"rowCount": rows, "columnCount": cols}},
+                        "fields": "gridProperties/rowCount,gridProperties/columnCount"
+                    }
+                } for worksheet, rows, cols in sizes
+            ]
+        })
+        for worksheet, rows, cols in sizes:
+            worksheet._properties.setdefault("gridProperties", {}).update({"rowCount": rows, "columnCount": cols})
+
+    def get_worksheets_cells(self, spreadsheet):
+        """
+        Returns the number of cells of the grid of each worksheet of a spreadsheet, by worksheet id
+        """
+        _, worksheets = self.open_spreadsheet(spreadsheet.id)
+        return dict((worksheet.id, worksheet.row_count * worksheet.col_count) for worksheet in worksheets)
+
+    def get_or_add_worksheets(self, document_id, titles):
+        """
+        Returns the worksheets of a document with the given titles, in order.
+        The missing ones are created in a single batchUpdate call.
+        """
+        spreadsheet, worksheets = self.open_spreadsheet(document_id)
+        worksheets_by_title = dict((worksheet.title, worksheet) for worksheet in worksheets)
+        missing_titles = []
+        for title in titles:
+            if title not in worksheets_by_title and title not in missing_titles:
+                missing_titles.append(title)
+        if missing_titles:
+            logger.info("Creating sheets {} in document {}".format(missing_titles, document_id))
+            response = spreadsheet.batch_update({
+                "requests": [
+                    {"addSheet": {"properties": {"title": title, "gridProperties": {"rowCount": 1000, "columnCount": 26}}}}
+                    for title in missing_titles
+                ]
+            })
+            for reply in response.get("replies", []):
+                worksheet = Worksheet(spreadsheet, reply["addSheet"]["properties"])
+                worksheets_by_title[worksheet.title] = worksheet
+            self.invalidate_metadata(document_id)
+        return [worksheets_by_title[title] for title in titles]
+
+    def clear_worksheets_values(self, spreadsheet, worksheets):
+        """
+        Clears the values of several worksheets in a single values.batchClear call
+        """
+        if not worksheets:
+            return
+        self.client.request(
+            "post",
+            SPREADSHEET_VALUES_BATCH_CLEAR_URL.format(spreadsheet.id),
+            json={"ranges": ["'{}'".format(worksheet.title.replace("'", "''")) for worksheet in worksheets]}
+        )
+
+    def add_staging_worksheet(self, worksheet, rows, cols):
+        """
+        Adds a hidden tab to the spreadsheet of worksheet, to be swapped with it by replace_worksheet
+        """
+        title = "{} (staging {})".format(worksheet.title, uuid.uuid4().hex[:8])
+        response = worksheet.spreadsheet.batch_update({
+            "requests": [{
+                "addSheet": {
+                    "properties": {"title": title, "hidden": True, "gridProperties": {"rowCount": max(rows, 1), "columnCount": max(cols, 1)}}
+                }
+            }]
+        })
+        return Worksheet(worksheet.spreadsheet, response["replies"][0]["addSheet"]["properties"])
+
+    def replace_worksheet(self, worksheet, new_worksheet):
+        """
+        Deletes worksheet and gives its title and position to new_worksheet, in a single atomic batchUpdate call
+        """
+        worksheet.spreadsheet.batch_update({
+            "requests": [
+                # Shown before the deletion, since the last visible tab of a document cannot be deleted
+                {
+                    "updateSheetProperties": {
+                        "properties": {"sheetId": new_worksheet.id, "hidden": False},
+                        "fields": "hidden"
+                    }
+                },
+                {"deleteSheet": {"sheetId": worksheet.id}},
+                {
+                    "updateSheetProperties": {
+                        "properties": {
+                            "sheetId": new_worksheet.id,
+                            "title": worksheet.title,
+                            "index": worksheet._properties.get("index", 0)
+                        },
+                        "fields": "title,index"
+                    }
+                }
+            ]
+        })
+        self.invalidate_metadata(worksheet.spreadsheet.id)
+
+    def copy_worksheet(self, source_document_id, destination_spreadsheet):
+        """
+        Copies the first tab of a document into another spreadsheet and returns the copy
+        """
+        source_spreadsheet, source_worksheets = self.open_spreadsheet(source_document_id)
+        self.invalidate_metadata(source_document_id)
+        response = self.client.request(
+            "post",
+            SPREADSHEET_SHEET_COPY_TO_URL.format(source_document_id, source_worksheets[0].id),
+            json={"destinationSpreadsheetId": destination_spreadsheet.id}
+        )
+        self.invalidate_metadata(destination_spreadsheet.id)
+        return Worksheet(destination_spreadsheet, response.json())
+
+    def delete_worksheet(self, worksheet):
+        worksheet.spreadsheet.batch_update({"requests": [{"deleteSheet": {"sheetId": worksheet.id}}]})
+        self.invalidate_metadata(worksheet.spreadsheet.id)
+
+    def get_last_modified(self, document_id):
+        """
+        Returns the Drive modifiedTime of a document, or None if it cannot be retrieved
+        """
+        try:
+            response = self.client.request(
+                "get",
+                DRIVE_FILES_API_V3_URL.format(document_id),
+                params={"fields": "modifiedTime", "supportsAllDrives": "true"}
+            )
+            return response.json().get("modifiedTime")
+        except Exception as error:
+            logger.warning("Could not retrieve the last modified time of document {}: {}".format(document_id, error))
+            return None
+
+    def get_values(self, worksheet, first_row, last_row, params=None):
+        a1_range = get_a1_range(worksheet.title, first_row, last_row, worksheet.col_count)
+        response = worksheet.spreadsheet.values_get(a1_range, params=params)
+        return response.get("values", [])
+
+    def get_used_width(self, worksheet, known_width, first_row=1):
+        """
+        Returns the index of the last non-empty column of a worksheet, knowing that its first known_width columns are used
+        and that the rows before first_row have already been read. Only the cells of the grid located after known_width
+        and from first_row on are requested, by column, so that the API trims the empty ones.
+        """
+        if worksheet.col_count <= known_width or worksheet.row_count < first_row:
+            return known_width
+        a1_range = get_a1_range(worksheet.title, first_row, worksheet.row_count, worksheet.col_count, first_column=known_width + 1)
+        response = worksheet.spreadsheet.values_get(a1_range, params={"majorDimension": "COLUMNS"})
+        return known_width + len(response.get("values", []))
+
+    def batch_get_values(self, spreadsheet, ranges, params=None):
+        response = spreadsheet.values_batch_get(ranges, params=dict(params) if params else None)
+        return [value_range.get("values", []) for value_range in response.get("valueRanges", [])]
+
+    def iter_worksheets_rows(self, worksheets, window_size=DSSConstants.READ_WINDOW_SIZE, max_rows=None, workers=1, params=None):
+        """
+        Yields a (worksheet, rows) tuple for each worksheet, in order.
+        The rows of each worksheet are fetched by windows of window_size rows, so that only a few windows
+        are kept in memory at a time. If max_rows is set, only the first max_rows rows of the sheets are requested.
+        The first windows of up to BATCH_GET_MAX_RANGES worksheets are fetched in a single values.batchGet call,
+        so that a workbook of small sheets is read in one round trip.
+        With more than one worker, the next windows are fetched in parallel while the current one is consumed.
+        params are passed to the API, for instance to set the valueRenderOption.
+        Like get_all_values, empty rows located between data rows are kept and trailing empty rows are dropped.
+        Unlike get_all_values, rows are not padded to the same length.
+        Grids are often much larger than their data, so the windows stop at the last data row of the worksheets,
+        which is probed first for the worksheets whose grid spans more than one window.
+        """
+        batches = []
+        tasks = []
+        batch_size = DSSConstants.BATCH_GET_MAX_RANGES
+        for batch_start in range(0, len(worksheets), batch_size):
+            batch = worksheets[batch_start:batch_start + batch_size]
+            last_rows = self.get_last_rows_to_read(batch, window_size, max_rows)
+            batch_windows = [get_windows(last_row, window_size) for last_row in last_rows]
+            ranges = []
+            for worksheet, windows in zip(batch, batch_windows):
+                first_window = windows[0] if windows else (1, 1)
+                ranges.append(get_a1_range(worksheet.title, first_window[0], first_window[1], worksheet.col_count))
+            tasks.append(partial(self.batch_get_values, batch[0].spreadsheet, ranges, params))
+            for worksheet, windows in zip(batch, batch_windows):
+                for first_row, last_row in windows[1:]:
+                    tasks.append(partial(self.get_values, worksheet, first_row, last_row, params))
+            batches.append((batch, batch_windows))
+
+        prefetcher = OrderedPrefetcher(tasks, workers)
+        try:
+            for batch, batch_windows in batches:
+                first_windows = prefetcher.next()
+                for worksheet, windows, first_window in zip(batch, batch_windows, first_windows):
+                    reader = WindowsReader(prefetcher, windows, first_window)
+                    yield worksheet, reader.iter_rows()
+                    # Windows left unread by the consumer are dropped
+                    prefetcher.skip(reader.windows_left)
+        finally:
+            prefetcher.close()
+
+    def get_last_rows_to_read(self, worksheets, window_size, max_rows=None):
+        last_rows = [get_last_row_to_read(worksheet, max_rows) for worksheet in worksheets]
+        probed_indexes = [index for index, last_row in enumerate(last_rows) if last_row > window_size]
+        if probed_indexes:
+            last_data_rows = self.get_last_data_rows([worksheets[index] for index in probed_indexes], probe_size=window_size)
+            for index, last_data_row in zip(probed_indexes, last_data_rows):
+                last_rows[index] = min(last_rows[index], last_data_row)
+        return last_rows
+
+    def get_last_data_rows(self, worksheets, probe_size=DSSConstants.COUNT_PROBE_SIZE):
+        """
+        Returns the index of the last non-empty row of each worksheet, without downloading the whole sheets.
+        The grid of each sheet is probed from its end by windows of rows, that double in size while they come back empty.
+        The probes of up to BATCH_GET_MAX_RANGES worksheets are sent in a single values.batchGet call.
+        """
+        last_data_rows = []
+        batch_size = DSSConstants.BATCH_GET_MAX_RANGES
+        for batch_start in range(0, len(worksheets), batch_size):
+            batch = worksheets[batch_start:batch_start + batch_size]
+            last_data_rows.extend(self._probe_last_data_rows(batch, probe_size))
+        return last_data_rows
+
+    def _probe_last_data_rows(self, worksheets, probe_size):
+        last_data_rows = [0] * len(worksheets)
+        probe_ends = [worksheet.row_count for worksheet in worksheets]
+        pending = [index for index in range(len(worksheets)) if probe_ends[index] > 0]
+        while pending:
+            probe_starts = {}
+            ranges = []
+            for index in pending:
+                probe_starts[index] = max(1, probe_ends[index] - probe_size + 1)
+                worksheet = worksheets[index]
+                ranges.append(get_a1_range(worksheet.title, probe_starts[index], probe_ends[index], worksheet.col_count))
+            windows = self.batch_get_values(worksheets[0].spreadsheet, ranges)
+            still_pending = []
+            for index, rows in zip(pending, windows):
+                if rows:
+                    # Empty rows before the last data row are returned as empty lists
+                    last_data_rows[index] = probe_starts[index] + len(rows) - 1
+                elif probe_starts[index] > 1:
+                    probe_ends[index] = probe_starts[index] - 1
+                    still_pending.append(index)
+            pending = still_pending
+            probe_size = min(2 * probe_size, DSSConstants.COUNT_PROBE_MAX_SIZE)
+        return last_data_rows
+
     def get_spreadsheet_title(self, document_id):
         try:
-            return self.client.open_by_key(document_id).title
+            spreadsheet, worksheets = self.open_spreadsheet(document_id)
+            return spreadsheet.title
         except gspread.exceptions.SpreadsheetNotFound as error:
             logger.error("{}".format(error))
             raise Exception("Trying to open non-existent or inaccessible spreadsheet document.")
@@ -0,0 +1,140 @@
+import os
+import gzip
+import json
+import hashlib
+import tempfile
+from safe_logger import SafeLogger
+
+
+logger = SafeLogger("googlesheets plugin", ["credentials", "access_token"])
+
+CACHE_FILE_EXTENSION = ".jsonl.gz"
+SCHEMA_FILE_EXTENSION = ".schema.json"
+
+
+def get_default_cache_folder():
+    dip_home = os.environ.get("DIP_HOME")
+    if dip_home:
+        return os.path.join(dip_home, "caches", "plugins", "googlesheets")
+    return os.path.join(tempfile.gettempdir(), "dss-plugin-googlesheets-cache")
+
+
+class ReadCache(object):
+    """
+    On-disk cache of the values of Google Sheets tabs.
+    Entries are keyed on the document id, the tab title and the document's Drive modifiedTime,
+    so an edit of the document makes all its entries stale, and on the read engine and value format the rows
+    were read with, since they do not return the same values. Each tab is stored as a gzipped JSON lines file,
+    whose first line holds the used width of the tab.
+    Inferred schemas are stored next to them as small JSON files.
+    When the cache grows beyond max_size_mb, the least recently used entries are evicted.
+    """
+    def __init__(self, max_size_mb, cache_folder=None):
+        self.cache_folder = cache_folder or get_default_cache_folder()
+        self.max_size = max_size_mb * 1024 * 1024
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+    def _get_path(self, key, extension=CACHE_FILE_EXTENSION):
+        key = json.dumps(key)
+        file_name = hashlib.sha1(key.encode("utf-8")).hexdigest() + extension
+        return os.path.join(self.cache_folder, file_name)
+
+    def get_rows(self, document_id, worksheet_title, last_modified, read_engine, value_format):
+        """
+        Returns an iterator over the cached rows of a tab and its used width, or None if the tab is not in cache.
+        """
+        if not last_modified:
+            return None
+        path = self._get_path([document_id, worksheet_title, last_modified, read_engine, value_format])
+        try:
+            file_handle = gzip.open(path, "rt", encoding="utf-8")
+        except (IOError, OSError):
+            return None
+        try:
+            header = json.loads(file_handle.readline())
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            header = None
+        if not isinstance(header, dict):
+            # Unreadable entry, or entry stored without its header by an older version of the plugin
+            file_handle.close()
+            return None
+        logger.info("Reading sheet '{}' from cache".format(worksheet_title))
+        return self._read_rows(file_handle), header.get("used_width")
+
+    def _read_rows(self, file_handle):
+        with file_handle:
+            for line in file_handle:
+                yield json.loads(line)
+
+    def write_rows(self, document_id, worksheet_title, last_modified, read_engine, value_format, rows, used_width):
+        """
+        Yields the rows while writing them to the cache, along with the used width of the tab.
+        The entry is only stored once all the rows have been consumed.
+        """
+        if not last_modified:
+            for row in rows:
+                yield row
+            return
+        path = self._get_path([document_id, worksheet_title, last_modified, read_engine, value_format])
+        temporary_path = "{}.{}-{}.tmp".format(path, os.getpid(), id(rows))
+        is_complete = False
+        try:
+            with gzip.open(temporary_path, "wt", encoding="utf-8", compresslevel=1) as file_handle:
+                file_handle.write(json.dumps({"used_width": used_width}))
+                file_handle.write("\n")
+                for row in rows:
+                    file_handle.write(json.dumps(row, separators=(",", ":")))
+                    file_handle.write("\n")
+                    yield row
+            is_complete = True
+        finally:
+            if is_complete:
+                os.replace(temporary_path, path)
+                logger.info("Sheet '{}' stored in cache".format(worksheet_title))
+                self.evict()
+            elif os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def get_schema(self, schema_key, last_modified):
+        if not last_modified:
+            return None
+        path = self._get_path([schema_key, last_modified], SCHEMA_FILE_EXTENSION)
+        try:
+            with open(path, "r") as file_handle:
+                schema = json.load(file_handle)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return schema
+
+    def set_schema(self, schema_key, last_modified, schema):
+        if not last_modified:
+            return
+        path = self._get_path([schema_key, last_modified], SCHEMA_FILE_EXTENSION)
+        temporary_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary_path, "w") as file_handle:
+            json.dump(schema, file_handle)
+        os.replace(temporary_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for file_name in os.listdir(self.cache_folder):
+            if not file_name.endswith((CACHE_FILE_EXTENSION, SCHEMA_FILE_EXTENSION)):
+                continue
+            path = os.path.join(self.cache_folder, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        cache_size = sum(entry[1] for entry in entries)
+        for last_used, size, path in sorted(entries):
+            if cache_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                cache_size -= size
+            except OSError:
+                continue
@@ -1,4 +1,9 @@
+import re
+import os
+import json
 import datetime
+from functools import lru_cache
+from itertools import islice
 
 
 class DSSConstants(object):
@@ -9,9 +14,34 @@ class DSSConstants(object):
         "single-sign-on": "There is a problem with the selected Single Sign On preset"
     }
     DEFAULT_DATASET_FORMAT = {'separator': '\t', 'style': 'unix', 'compress': ''}
-    PLUGIN_VERSION = '1.3.1'
+    PLUGIN_VERSION = '1.4.0'
     DSS_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
     GSPREAD_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+    READ_WINDOW_SIZE = 5000
+    BATCH_GET_MAX_RANGES = 10
+    COUNT_PROBE_SIZE = 1000
+    COUNT_PROBE_MAX_SIZE = 50000
+    PROGRESS_REPORT_RECORDS = 5000
+    SLUG_CACHE_SIZE = 10000
+    READ_CACHE_MAX_SIZE = 500
+    SCHEMA_INFERENCE_SAMPLE_SIZE = 1000
+    MAX_WORKERS = 8
+    WRITE_BLOCK_SIZE = 2000
+    MAX_SPREADSHEET_CELLS = 10000000
+    GRID_GROWTH_BLOCKS = 4
+    # Default per user quotas, see https://developers.google.com/sheets/api/limits
+    SHEETS_READ_REQUESTS_PER_MINUTE = 60
+    SHEETS_WRITE_REQUESTS_PER_MINUTE = 60
+    DRIVE_REQUESTS_PER_MINUTE = 12000
+    MAX_RETRIES_PER_REQUEST = 8
+    RETRY_BUDGET = 100
+    MAX_BACKOFF = 64
+    APPEND_TARGET_SIZE_KB = 1024
+    APPEND_MIN_TARGET_SIZE_KB = 32
+    APPEND_MAX_CELLS = 100000
+    APPEND_SLOW_REQUEST_SECONDS = 10
+    APPEND_FAST_REQUEST_SECONDS = 2
+    UPLOAD_QUEUE_SIZE = 2
 
 
 def extract_credentials(config, can_raise=True):
@@ -51,6 +81,28 @@ def extract_credentials(config, can_raise=True):
         return credentials, credential_type, error_message
 
 
+def get_service_account_credentials(input_credentials):
+    """
+    Takes the input param 'credentials' that can accept a JSON token or a path to a file
+    and returns a dict.
+    """
+    test_file = input_credentials.splitlines()[0]
+    if os.path.isfile(test_file):
+        try:
+            with open(test_file, 'r') as f:
+                credentials = json.load(f)
+                f.close()
+        except Exception as e:
+            raise ValueError("Unable to read the JSON Service Account from file '%s'.\n%s" % (test_file, e))
+    else:
+        try:
+            credentials = json.loads(input_credentials)
+        except Exception as e:
+            raise Exception("Unable to read the JSON Service Account.\n%s" % e)
+
+    return credentials
+
+
 def get_tab_ids(config):
     # New preset overides old preset
     # If new preset is empty, new preset = [old preset]
@@ -67,35 +119,134 @@ def get_tab_ids(config):
     return tabs_ids
 
 
-def get_unique_slugs(list_of_names):
+@lru_cache(maxsize=DSSConstants.SLUG_CACHE_SIZE)
+def get_slug(name, max_length=0):
     from slugify import slugify
-    list_unique_slugs = []
-    for name in list_of_names:
-        slug_name = slugify(name, separator="_", lowercase=False)
-        if slug_name == '':
-            slug_name = 'none'
-        test_string = slug_name
-        i = 0
-        while test_string in list_unique_slugs:
-            i += 1
-            test_string = slug_name + '_' + str(i)
-        list_unique_slugs.append(test_string)
-    return list_unique_slugs
+    return slugify(name, max_length=max_length, separator="_", lowercase=False)
+
+
+class UniqueNameAllocator(object):
+    """
+    Makes names unique by suffixing the duplicates with _1, _2...
+    Names are optionally slugified first, max_length limiting the size of the slug before its suffix.
+    Each base name keeps the next suffix to try, so allocating n names costs O(n) set lookups.
+    """
+    def __init__(self, slugify_names=True, max_length=0):
+        self.slugify_names = slugify_names
+        self.max_length = max_length
+        self.allocated_names = set()
+        self.next_suffixes = {}
+
+    def allocate(self, name):
+        base_name = get_slug(name, self.max_length) if self.slugify_names else name
+        if base_name == '':
+            base_name = 'none'
+        suffix = self.next_suffixes.get(base_name, 0)
+        unique_name = base_name if suffix == 0 else base_name + '_' + str(suffix)
+        # Suffixed names can also be taken by names allocated before, like "a_1" for the second "a"
+        while unique_name in self.allocated_names:
+            suffix += 1
+            unique_name = base_name + '_' + str(suffix)
+        self.next_suffixes[base_name] = suffix + 1
+        self.allocated_names.add(unique_name)
+        return unique_name
+
+    def allocate_all(self, names):
+        return [self.allocate(name) for name in names]
+
+
+def get_unique_slugs(list_of_names):
+    return UniqueNameAllocator().allocate_all(list_of_names)
 
 
 def get_unique_names(list_of_names):
-    list_unique_slugs = []
-    for name in list_of_names:
-        slug_name = name
-        if slug_name == '':
-            slug_name = 'none'
-        test_string = slug_name
-        i = 0
-        while test_string in list_unique_slugs:
-            i += 1
-            test_string = slug_name + '_' + str(i)
-        list_unique_slugs.append(test_string)
-    return list_unique_slugs
+    return UniqueNameAllocator(slugify_names=False).allocate_all(list_of_names)
+
+
+def peek_rows_width(rows, count):
+    """
+    Reads up to count rows ahead and returns them with the width of the widest one, and whether more rows follow
+    """
+    first_rows = list(islice(rows, count))
+    width = max([len(row) for row in first_rows] or [0])
+    return first_rows, width, len(first_rows) == count
+
+
+def pad_row(row, width):
+    if len(row) < width:
+        row.extend([""] * (width - len(row)))
+    return row
+
+
+def fill_row(row, width):
+    """
+    Returns a copy of row padded to width, with its None cells replaced by empty strings,
+    since values.update and values.batchUpdate leave the cells sent as null untouched
+    """
+    return ["" if value is None else value for value in row] + [""] * (width - len(row))
+
+
+def cell_to_text(value):
+    """
+    Normalises a typed cell value to the text of a formatted cell, so that values of different sources compare equal
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, float) and value.is_integer():
+        return "{}".format(int(value))
+    return "{}".format(value)
+
+
+def iter_trimmed_rows(rows):
+    """
+    Trims rows like the values API does: empty cells at the end of rows and empty rows at the end are dropped
+    """
+    pending_empty_rows = 0
+    for row in rows:
+        row = list(row)
+        while row and row[-1] == "":
+            row.pop()
+        if not row:
+            pending_empty_rows += 1
+            continue
+        for _ in range(pending_empty_rows):
+            yield []
+        pending_empty_rows = 0
+        yield row
+
+
+def _build_column_pattern(value_pattern):
+    # Matches a whole column of values joined by line feeds
+    return re.compile("(?:" + value_pattern + ")(?:\n(?:" + value_pattern + "))*")
+
+
+COLUMN_TYPE_PATTERNS = [
+    ("bigint", _build_column_pattern(r"[+-]?(?:0|[1-9]\d{0,17})")),
+    ("double", _build_column_pattern(r"[+-]?(?:(?:0|[1-9]\d*)(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?")),
+    ("boolean", _build_column_pattern(r"true|false|TRUE|FALSE|True|False")),
+    ("date", _build_column_pattern(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d{1,9})?(?:Z|[+-]\d{2}:?\d{2})?"))
+]
+
+
+def get_column_type(values):
+    """
+    Returns the DSS type matching all the non-empty values of a column, or string.
+    Distinct values are joined and tested against each type with a single regex call
+    instead of parsing the values one by one.
+    """
+    distinct_values = set(value for value in values if value != "")
+    if not distinct_values:
+        return "string"
+    joined_values = "\n".join("{}".format(value) for value in distinct_values)
+    if joined_values.count("\n") != len(distinct_values) - 1:
+        # Some values are multiline strings
+        return "string"
+    for column_type, column_pattern in COLUMN_TYPE_PATTERNS:
+        if column_pattern.fullmatch(joined_values):
+            return column_type
+    return "string"
 
 
 def mark_date_columns(schema):
@@ -121,10 +272,27 @@ def format_date(date, from_format, to_format):
         return date
 
 
+# DSS_DATE_FORMAT with zero padded fields, which GSPREAD_DATE_FORMAT keeps at the same offsets.
+# Years below 1000 are excluded since strftime does not pad them.
+DSS_DATE_PATTERN = re.compile(r"[1-9][0-9]{3}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12][0-9]|3[01])T(?:[01][0-9]|2[0-3]):[0-5][0-9]:[0-5][0-9]\.[0-9]{1,6}Z")
+
+
+def format_dss_date(date):
+    """
+    Converts a date from DSS_DATE_FORMAT to GSPREAD_DATE_FORMAT, with the same output as format_date.
+    Well formed dates are converted by slicing, any other value goes through strptime / strftime.
+    """
+    if isinstance(date, str) and DSS_DATE_PATTERN.fullmatch(date):
+        # Days past the 28th may not exist in the month, strptime raises on them
+        if date[8:10] > "28":
+            datetime.datetime(int(date[:4]), int(date[5:7]), int(date[8:10]))
+        return date[:10] + " " + date[11:19]
+    return format_date(date, DSSConstants.DSS_DATE_FORMAT, DSSConstants.GSPREAD_DATE_FORMAT)
+
+
 def convert_dates_in_row(row, date_columns):
     for date_column in date_columns:
-        row[date_column] = format_date(
-            row[date_column], DSSConstants.DSS_DATE_FORMAT, DSSConstants.GSPREAD_DATE_FORMAT)
+        row[date_column] = format_dss_date(row[date_column])
     return row
 
 
@@ -0,0 +1,138 @@
+import threading
+import requests
+from queue import Queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from googlesheets_common import DSSConstants
+
+
+class ThreadLocalHttpSession(object):
+    """
+    Replacement for the requests.Session used by the gspread client.
+    requests.Session is not guaranteed to be thread safe, so each thread gets its own session.
+    The headers set by the client, such as the authorization token, are shared by all threads.
+    """
+    def __init__(self):
+        self.headers = {}
+        self._local = threading.local()
+
+    def _get_session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        session.headers.update(self.headers)
+        return session
+
+    def request(self, method, url, **kwargs):
+        return self._get_session().request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("get", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("post", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("put", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("patch", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("delete", url, **kwargs)
+
+
+def get_workers_count(workers):
+    # Capped to stay under the per user quota of the Sheets API
+    return max(1, min(workers or 1, DSSConstants.MAX_WORKERS))
+
+
+class OrderedPrefetcher(object):
+    """
+    Runs a sequence of tasks and returns their results in order.
+    With more than one worker, up to workers tasks are run ahead of the consumer by a thread pool,
+    so that at most workers results are held in memory.
+    """
+    def __init__(self, tasks, workers=1):
+        self.tasks = iter(tasks)
+        self.workers = get_workers_count(workers)
+        self.executor = None
+        self.pending = deque()
+        if self.workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def _fill(self):
+        while len(self.pending) < self.workers:
+            task = next(self.tasks, None)
+            if task is None:
+                return
+            self.pending.append(self.executor.submit(task))
+
+    def next(self):
+        if self.executor is None:
+            task = next(self.tasks)
+            return task()
+        self._fill()
+        if not self.pending:
+            raise StopIteration()
+        result = self.pending.popleft().result()
+        self._fill()
+        return result
+
+    def skip(self, count):
+        """
+        Drops the next count tasks, without running them when they are not started yet
+        """
+        for _ in range(count):
+            if self.pending:
+                self.pending.popleft().cancel()
+            elif next(self.tasks, None) is None:
+                return
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+class BackgroundUploader(object):
+    """
+    Runs uploads on a background thread, in the order they are submitted.
+    At most max_pending uploads wait in the queue, so that memory stays bounded and the producer
+    is slowed down to the pace of the uploads. The first upload error is raised to the producer
+    on its next call, and the uploads submitted after it are dropped.
+    """
+    def __init__(self, max_pending=DSSConstants.UPLOAD_QUEUE_SIZE):
+        self.queue = Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="googlesheets-uploader")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            upload = self.queue.get()
+            if upload is None:
+                return
+            if self.error is None:
+                try:
+                    upload()
+                except Exception as error:
+                    self.error = error
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, upload):
+        self.raise_error()
+        self.queue.put(upload)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
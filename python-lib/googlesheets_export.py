@@ -0,0 +1,94 @@
+import io
+import csv
+import json
+import tempfile
+from itertools import chain
+from googleapiclient.errors import HttpError
+from safe_logger import SafeLogger
+from googlesheets_common import cell_to_text, iter_trimmed_rows
+from dku_googledrive.googledrive_utils import GoogleDriveUtils as gdu
+
+
+logger = SafeLogger("googlesheets plugin", ["credentials", "access_token"])
+
+
+class ExportTooLargeError(Exception):
+    pass
+
+
+def get_error_reason(error):
+    try:
+        return json.loads(error.content).get("error", {}).get("errors", [{}])[0].get("reason")
+    except (ValueError, AttributeError, IndexError):
+        return None
+
+
+def is_exported_as_xlsx(worksheets):
+    # Only the first tab of a document can be exported as CSV
+    return not (len(worksheets) == 1 and worksheets[0]._properties.get("index", 0) == 0)
+
+
+class DriveExportReader(object):
+    """
+    Reads the tabs of a document from a Drive export instead of the values API.
+    When only the first tab is read, the document is exported as CSV, otherwise as XLSX, parsed with openpyxl,
+    unless as_xlsx is set.
+    The export is downloaded by chunks to a temporary file and parsed incrementally.
+    Drive refuses to export documents larger than 10 MB, in which case ExportTooLargeError is raised.
+    Values from a CSV export are formatted like the values API ones, values from an XLSX export are the raw cell values.
+    The used width of a sheet is read from its CSV export, whose rows all span the used range of the sheet.
+    """
+    def __init__(self, drive_session, document_id, worksheets, as_xlsx=None):
+        self.drive_session = drive_session
+        self.document_id = document_id
+        self.worksheets = worksheets
+        self.as_xlsx = is_exported_as_xlsx(worksheets) if as_xlsx is None else as_xlsx
+        self.file_handle = None
+
+    def download(self):
+        self.drive_session.output_google_sheets_as_xlsx = self.as_xlsx
+        self.file_handle = tempfile.TemporaryFile()
+        try:
+            self.drive_session.googledrive_download({gdu.ID: self.document_id, gdu.MIME_TYPE: gdu.SPREADSHEET}, self.file_handle)
+        except HttpError as error:
+            self.file_handle.close()
+            if get_error_reason(error) == "exportSizeLimitExceeded":
+                raise ExportTooLargeError("Document {} is too large to be exported by Drive".format(self.document_id))
+            raise
+        logger.info("Document {} exported as {} ({} bytes)".format(
+            self.document_id, "XLSX" if self.as_xlsx else "CSV", self.file_handle.tell()
+        ))
+        self.file_handle.seek(0)
+
+    def iter_worksheets_rows(self):
+        """
+        Yields a (worksheet, rows, used_width) tuple for each worksheet. Like with GoogleSheetsSession.iter_worksheets_rows,
+        rows are trimmed. used_width is None when the export does not tell it.
+        """
+        if self.file_handle is None:
+            self.download()
+        with self.file_handle:
+            if self.as_xlsx:
+                for worksheet_rows in self.iter_xlsx_worksheets_rows():
+                    yield worksheet_rows
+            else:
+                with io.TextIOWrapper(self.file_handle, encoding="utf-8", newline="") as text_file_handle:
+                    csv_rows = csv.reader(text_file_handle)
+                    first_row = next(csv_rows, [])
+                    yield self.worksheets[0], iter_trimmed_rows(chain([first_row], csv_rows)), len(first_row)
+
+    def iter_xlsx_worksheets_rows(self):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise Exception("The openpyxl package is missing, the code environment of the plugin must be updated to read several sheets from a Drive export")
+        workbook = load_workbook(self.file_handle, read_only=True, data_only=True)
+        try:
+            for worksheet in self.worksheets:
+                # The export renames the sheets whose title is not a valid XLSX sheet name, but keeps their order
+                xlsx_worksheet = workbook[workbook.sheetnames[worksheet._properties.get("index", 0)]]
+                rows = xlsx_worksheet.iter_rows(values_only=True)
+                # The dimension of an XLSX sheet can span formatted empty cells, so its width is not used
+                yield worksheet, iter_trimmed_rows([cell_to_text(value) for value in row] for row in rows), None
+        finally:
+            workbook.close()
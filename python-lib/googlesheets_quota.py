@@ -0,0 +1,104 @@
+import random
+import threading
+import time
+from safe_logger import SafeLogger
+from googlesheets_common import DSSConstants
+
+
+logger = SafeLogger("googlesheets plugin", ["credentials", "access_token"])
+
+SHEETS_READ = "sheets_read"
+SHEETS_WRITE = "sheets_write"
+DRIVE = "drive"
+
+RETRYABLE_STATUSES = [429, 500, 502, 503, 504]
+
+
+class TokenBucket(object):
+    """
+    Lets through up to requests_per_minute requests per minute, with bursts up to the same number.
+    """
+    def __init__(self, requests_per_minute):
+        self.capacity = float(requests_per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class QuotaScheduler(object):
+    """
+    Paces the requests sent to the Sheets and Drive APIs and decides how long to wait before retrying.
+    Requests go through a token bucket per quota, so that jobs run close to the quotas instead of hitting them.
+    Failed requests are retried with an exponential backoff with jitter, or after the delay set by the
+    Retry-After header. The number of retries of the whole job is capped by retry_budget.
+    """
+    def __init__(self, retry_budget=DSSConstants.RETRY_BUDGET):
+        self.buckets = {
+            SHEETS_READ: TokenBucket(DSSConstants.SHEETS_READ_REQUESTS_PER_MINUTE),
+            SHEETS_WRITE: TokenBucket(DSSConstants.SHEETS_WRITE_REQUESTS_PER_MINUTE),
+            DRIVE: TokenBucket(DSSConstants.DRIVE_REQUESTS_PER_MINUTE)
+        }
+        self.retry_budget = retry_budget
+        self.lock = threading.Lock()
+
+    def acquire(self, quota):
+        self.buckets[quota].acquire()
+
+    def consume_retry(self):
+        with self.lock:
+            if self.retry_budget <= 0:
+                return False
+            self.retry_budget -= 1
+            return True
+
+    def get_retry_delay(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return max(0, float(retry_after))
+            except ValueError:
+                # Retry-After can also be an HTTP date, the backoff is used instead
+                pass
+        return min(DSSConstants.MAX_BACKOFF, 2 ** attempt) + random.uniform(0, 1)
+
+    def wait_before_retry(self, status, attempt, retry_after=None, retryable_statuses=RETRYABLE_STATUSES):
+        """
+        Waits before the next attempt of a failed request.
+        Returns False when the request should not be retried.
+        """
+        if status not in retryable_statuses or attempt >= DSSConstants.MAX_RETRIES_PER_REQUEST:
+            return False
+        if not self.consume_retry():
+            logger.warning("The retry budget of the job is exhausted")
+            return False
+        delay = self.get_retry_delay(attempt, retry_after)
+        logger.warning("Error {}, retrying in {:.1f}s (attempt {})".format(status, delay, attempt + 1))
+        time.sleep(delay)
+        return True
+
+
+quota_scheduler = None
+quota_scheduler_lock = threading.Lock()
+
+
+def get_quota_scheduler():
+    """
+    Returns the scheduler of the process, shared by all the sessions so that they share the quotas
+    """
+    global quota_scheduler
+    with quota_scheduler_lock:
+        if quota_scheduler is None:
+            quota_scheduler = QuotaScheduler()
+        return quota_scheduler
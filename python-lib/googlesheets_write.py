@@ -0,0 +1,627 @@
+import io
+import csv
+import json
+import time
+import uuid
+import tempfile
+import threading
+import gspread
+from collections import OrderedDict
+from functools import partial
+from googlesheets import get_a1_range
+from googlesheets_append import append_rows
+from googlesheets_common import DSSConstants, pad_row, fill_row, cell_to_text
+from googlesheets_concurrency import BackgroundUploader
+from safe_logger import SafeLogger
+
+
+logger = SafeLogger("googlesheets plugin", ["credentials", "access_token"])
+
+# Values are read back as they were entered, so that they can be compared to the written ones
+CURRENT_VALUES_PARAMS = {"valueRenderOption": "FORMULA", "dateTimeRenderOption": "FORMATTED_STRING"}
+
+
+class GridBudget(object):
+    """
+    Tracks the grid sizes of the worksheets of a spreadsheet, whose total Google limits to MAX_SPREADSHEET_CELLS cells,
+    so that grids can be grown ahead of the written rows without pushing the spreadsheet over the limit
+    """
+    def __init__(self, session, spreadsheet):
+        self.cells = session.get_worksheets_cells(spreadsheet)
+
+    def get_grown_row_count(self, worksheet, last_row, cols, block_size):
+        """
+        Returns the row count of a grid that must hold last_row rows. It is grown geometrically, by at most
+        GRID_GROWTH_BLOCKS blocks ahead, to keep the number of resize calls low, within the cells left by the other grids.
+        """
+        other_cells = sum(cells for worksheet_id, cells in self.cells.items() if worksheet_id != worksheet.id)
+        max_rows = (DSSConstants.MAX_SPREADSHEET_CELLS - other_cells) // max(cols, 1)
+        rows = max(last_row, min(2 * worksheet.row_count, last_row + DSSConstants.GRID_GROWTH_BLOCKS * block_size, max_rows))
+        self.set_size(worksheet, rows, cols)
+        return rows
+
+    def set_size(self, worksheet, rows, cols):
+        self.cells[worksheet.id] = rows * cols
+
+
+class OverwriteBlockWriter(object):
+    """
+    Overwrites a sheet by sending blocks of rows to consecutive ranges as they are written,
+    so that only one block of rows is kept in memory.
+    Unless clear is False, the sheet is emptied before the first block is sent. Its grid grows
+    as blocks arrive and is trimmed to the written rows on close.
+    """
+    def __init__(self, session, worksheet, value_input_option, num_columns, block_size=DSSConstants.WRITE_BLOCK_SIZE, clear=True):
+        self.session = session
+        self.worksheet = worksheet
+        self.value_input_option = value_input_option
+        self.num_columns = max(num_columns, 1)
+        self.block_size = block_size
+        self.clear = clear
+        self.buffer = []
+        self.next_row = 1
+        self.is_started = False
+        self.grid_budget = None
+
+    def write_row(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.block_size:
+            self.flush()
+
+    def start(self):
+        if self.clear:
+            self.session.clear_worksheet(self.worksheet, cols=self.num_columns)
+        self.grid_budget = GridBudget(self.session, self.worksheet.spreadsheet)
+        self.is_started = True
+
+    def flush(self):
+        if not self.is_started:
+            self.start()
+        if not self.buffer:
+            return
+        last_row = self.next_row + len(self.buffer) - 1
+        if last_row > self.worksheet.row_count:
+            rows = self.grid_budget.get_grown_row_count(self.worksheet, last_row, self.worksheet.col_count, self.block_size)
+            self.session.resize_worksheet(self.worksheet, rows=rows)
+        self.send_block(self.buffer, self.next_row, last_row)
+        self.next_row = last_row + 1
+        self.buffer = []
+
+    def send_block(self, rows, first_row, last_row):
+        self.worksheet.spreadsheet.values_update(
+            get_a1_range(self.worksheet.title, first_row, last_row, self.num_columns),
+            params={"valueInputOption": self.value_input_option},
+            body={"values": rows}
+        )
+
+    def close(self):
+        self.flush()
+        self.session.resize_worksheet(self.worksheet, rows=max(self.next_row - 1, 1))
+
+
+class BulkOverwriteBlockWriter(OverwriteBlockWriter):
+    """
+    OverwriteBlockWriter sending its blocks as CSV text in pasteData requests of spreadsheets.batchUpdate,
+    which the sheet parses like USER_ENTERED values, with a smaller payload than the values API.
+    There is no raw equivalent, typed cells being several times larger than the values API payload,
+    so RAW blocks still go through the values API.
+    """
+    def send_block(self, rows, first_row, last_row):
+        if self.value_input_option != "USER_ENTERED":
+            return super(BulkOverwriteBlockWriter, self).send_block(rows, first_row, last_row)
+        data = io.StringIO()
+        # None is written as an empty cell, booleans as True / False which the sheet parses as booleans
+        csv.writer(data, lineterminator="\n").writerows(rows)
+        self.worksheet.spreadsheet.batch_update({
+            "requests": [{
+                "pasteData": {
+                    "coordinate": {"sheetId": self.worksheet.id, "rowIndex": first_row - 1, "columnIndex": 0},
+                    "data": data.getvalue(),
+                    "type": "PASTE_NORMAL",
+                    "delimiter": ","
+                }
+            }]
+        })
+
+
+def get_overwrite_block_writer_class(write_engine):
+    if write_engine == "bulk":
+        return BulkOverwriteBlockWriter
+    return OverwriteBlockWriter
+
+
+class StagedOverwriteWriter(object):
+    """
+    Overwrites a sheet by writing the rows by blocks to a hidden staging tab, which replaces the sheet
+    on close in a single batchUpdate call, so that readers never see a partially written sheet.
+    The staging tab is deleted if the writing fails.
+    """
+    def __init__(self, session, worksheet, value_input_option, num_columns, block_size=DSSConstants.WRITE_BLOCK_SIZE,
+                 block_writer_class=OverwriteBlockWriter):
+        self.session = session
+        self.worksheet = worksheet
+        self.value_input_option = value_input_option
+        self.num_columns = num_columns
+        self.block_size = block_size
+        self.block_writer_class = block_writer_class
+        self.block_writer = None
+
+    def start(self):
+        staging_worksheet = self.session.add_staging_worksheet(self.worksheet, self.block_size, self.num_columns)
+        logger.info("Writing sheet '{}' to staging tab '{}'".format(self.worksheet.title, staging_worksheet.title))
+        self.block_writer = self.block_writer_class(
+            self.session, staging_worksheet, self.value_input_option, self.num_columns, self.block_size, clear=False
+        )
+
+    def abort(self):
+        logger.warning("Deleting staging tab '{}'".format(self.block_writer.worksheet.title))
+        try:
+            self.session.delete_worksheet(self.block_writer.worksheet)
+        except Exception as error:
+            logger.error("The staging tab could not be deleted: {}".format(error))
+
+    def write_row(self, row):
+        if self.block_writer is None:
+            self.start()
+        try:
+            self.block_writer.write_row(row)
+        except Exception:
+            self.abort()
+            raise
+
+    def flush(self):
+        if self.block_writer is None:
+            return
+        try:
+            self.block_writer.flush()
+        except Exception:
+            self.abort()
+            raise
+
+    def close(self):
+        if self.block_writer is None:
+            self.start()
+        try:
+            self.block_writer.close()
+            self.session.replace_worksheet(self.worksheet, self.block_writer.worksheet)
+        except Exception:
+            self.abort()
+            raise
+
+
+class DriveImportOverwriteWriter(object):
+    """
+    Overwrites a sheet through a Drive import. The rows are streamed to a temporary CSV file, which is uploaded
+    resumably and converted by Drive into a new document. Its tab is copied into the spreadsheet with copyTo
+    and swapped with the sheet, so the cell API is only used for the final step.
+    Drive parses the values like USER_ENTERED values, with the locale of the Drive account.
+    """
+    def __init__(self, session, drive_session, worksheet, value_input_option):
+        if value_input_option != "USER_ENTERED":
+            raise Exception("Sheets can only be imported through Drive with interpreted values")
+        self.session = session
+        self.drive_session = drive_session
+        self.worksheet = worksheet
+        self.file_handle = tempfile.TemporaryFile()
+        self.text_file_handle = io.TextIOWrapper(self.file_handle, encoding="utf-8", newline="")
+        self.csv_writer = csv.writer(self.text_file_handle)
+
+    def write_row(self, row):
+        self.csv_writer.writerow(row)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.text_file_handle:
+            self.text_file_handle.flush()
+            self.file_handle.seek(0)
+            self.drive_session.write_as_google_doc = True
+            document = self.drive_session.googledrive_upload(
+                "dss-googlesheets-import-{}.csv".format(uuid.uuid4().hex),
+                self.file_handle,
+                parent_id=self.drive_session.root_id
+            )
+        document_id = document.get("id")
+        logger.info("Rows of sheet '{}' imported in Drive document {}".format(self.worksheet.title, document_id))
+        try:
+            imported_worksheet = self.session.copy_worksheet(document_id, self.worksheet.spreadsheet)
+            self.session.replace_worksheet(self.worksheet, imported_worksheet)
+        finally:
+            self.drive_session.googledrive_delete({"id": document_id, "parents": []})
+
+
+class AdaptiveBatcher(object):
+    """
+    Decides when a batch of appended rows is large enough to be sent, from its serialized size and cell count.
+    The target size is halved when a request is slow or too large, and grows back to target_size_kb
+    while requests are fast. max_rows stays an upper bound on the number of rows of a batch.
+    """
+    def __init__(self, max_rows, target_size_kb=DSSConstants.APPEND_TARGET_SIZE_KB):
+        self.max_rows = max_rows
+        self.max_target_size = target_size_kb * 1024
+        self.min_target_size = min(self.max_target_size, DSSConstants.APPEND_MIN_TARGET_SIZE_KB * 1024)
+        self.target_size = self.max_target_size
+        self.reset()
+
+    def reset(self):
+        self.rows = 0
+        self.size = 0
+        self.cells = 0
+
+    def add(self, row):
+        """
+        Accounts for a new row of the batch, returns True when the batch should be sent
+        """
+        self.rows += 1
+        self.size += len(json.dumps(row))
+        self.cells += len(row)
+        return self.rows >= self.max_rows or self.size >= self.target_size or self.cells >= DSSConstants.APPEND_MAX_CELLS
+
+    def shrink(self):
+        self.target_size = max(self.min_target_size, self.target_size // 2)
+
+    def record_too_large(self, size):
+        # Batches will not grow back to the rejected size
+        self.max_target_size = max(self.min_target_size, size // 2)
+        self.target_size = min(self.target_size, self.max_target_size)
+
+    def record_request(self, duration):
+        if duration > DSSConstants.APPEND_SLOW_REQUEST_SECONDS:
+            self.shrink()
+        elif duration < DSSConstants.APPEND_FAST_REQUEST_SECONDS:
+            self.target_size = min(self.max_target_size, int(self.target_size * 1.5))
+
+
+def is_payload_too_large(error):
+    return error.response.status_code == 413 or (
+        error.response.status_code == 400 and "payload size exceeds" in "{}".format(error).lower()
+    )
+
+
+class AppendBlockWriter(object):
+    """
+    Appends batches of rows after the last row of a sheet as they are written.
+    Batches are sized by an AdaptiveBatcher, with at most block_size rows.
+    A batch rejected as too large is split in two and sent again.
+    insertion_delay, in hundredths of a second, is waited before sending each full batch.
+    With background set, batches are sent by a BackgroundUploader while the next ones are being written.
+    """
+    def __init__(self, worksheet, value_input_option, block_size=DSSConstants.WRITE_BLOCK_SIZE, insertion_delay=0,
+                 target_size_kb=DSSConstants.APPEND_TARGET_SIZE_KB, background=False):
+        self.worksheet = worksheet
+        self.worksheet.append_rows = append_rows.__get__(worksheet, worksheet.__class__)
+        self.value_input_option = value_input_option
+        self.batcher = AdaptiveBatcher(block_size, target_size_kb)
+        self.insertion_delay = insertion_delay
+        self.uploader = BackgroundUploader() if background else None
+        self.buffer = []
+
+    def write_row(self, row):
+        self.buffer.append(row)
+        if self.batcher.add(row):
+            if self.insertion_delay > 0:
+                time.sleep(0.01 * self.insertion_delay)
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            if self.uploader is None:
+                self.send(self.buffer)
+            else:
+                self.uploader.submit(partial(self.send, self.buffer))
+        self.buffer = []
+        self.batcher.reset()
+
+    def send(self, rows):
+        start = time.time()
+        try:
+            self.worksheet.append_rows(rows, self.value_input_option)
+        except gspread.exceptions.APIError as error:
+            if len(rows) < 2 or not is_payload_too_large(error):
+                raise
+            logger.warning("Batch of {} rows too large, splitting it".format(len(rows)))
+            self.batcher.record_too_large(len(json.dumps(rows)))
+            middle = len(rows) // 2
+            self.send(rows[:middle])
+            self.send(rows[middle:])
+            return
+        self.batcher.record_request(time.time() - start)
+
+    def close(self):
+        self.flush()
+        if self.uploader is not None:
+            self.uploader.close()
+
+
+class MultiSheetBlockWriter(object):
+    """
+    Writes rows to several sheets of a spreadsheet, packing the rows of all the sheets in shared values.batchUpdate calls
+    sized by an AdaptiveBatcher. The rows of each sheet are written from its row in first_rows, and the grids
+    of the sheets that are too small are grown in a single batchUpdate call before each flush, within the cell limit
+    of the spreadsheet, and trimmed on close.
+    write_row can be called from several threads.
+    """
+    def __init__(self, session, spreadsheet, value_input_option, first_rows, block_size=DSSConstants.WRITE_BLOCK_SIZE,
+                 insertion_delay=0, target_size_kb=DSSConstants.APPEND_TARGET_SIZE_KB):
+        self.session = session
+        self.spreadsheet = spreadsheet
+        self.value_input_option = value_input_option
+        self.next_rows = dict(first_rows)
+        self.block_size = block_size
+        self.batcher = AdaptiveBatcher(block_size, target_size_kb)
+        self.insertion_delay = insertion_delay
+        # All the grids grow against the cell limit of the spreadsheet they share
+        self.grid_budget = GridBudget(session, spreadsheet)
+        self.buffers = OrderedDict()
+        self.grown_worksheets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def write_row(self, worksheet, row):
+        with self.lock:
+            self.buffers.setdefault(worksheet.id, (worksheet, []))[1].append(row)
+            if self.batcher.add(row):
+                if self.insertion_delay > 0:
+                    time.sleep(0.01 * self.insertion_delay)
+                self._flush()
+
+    def _flush(self):
+        if not self.buffers:
+            return
+        sizes = []
+        data = []
+        for worksheet, rows in self.buffers.values():
+            first_row = self.next_rows.get(worksheet.id, 1)
+            last_row = first_row + len(rows) - 1
+            width = max(max(len(row) for row in rows), 1)
+            if last_row > worksheet.row_count or width > worksheet.col_count:
+                # The grid is grown ahead of the rows to keep the number of resize calls low, and trimmed on close
+                cols = max(width, worksheet.col_count)
+                grid_rows = worksheet.row_count
+                if last_row > grid_rows:
+                    grid_rows = self.grid_budget.get_grown_row_count(worksheet, last_row, cols, self.block_size)
+                else:
+                    self.grid_budget.set_size(worksheet, grid_rows, cols)
+                sizes.append((worksheet, grid_rows, cols))
+                self.grown_worksheets[worksheet.id] = worksheet
+            data.append({"range": get_a1_range(worksheet.title, first_row, last_row, width), "values": rows})
+            self.next_rows[worksheet.id] = last_row + 1
+        self.session.resize_worksheets(self.spreadsheet, sizes)
+        start = time.time()
+        self.spreadsheet.values_batch_update(body={"valueInputOption": self.value_input_option, "data": data})
+        self.batcher.record_request(time.time() - start)
+        self.buffers = OrderedDict()
+        self.batcher.reset()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.session.resize_worksheets(self.spreadsheet, [
+                (worksheet, self.next_rows[worksheet.id] - 1, worksheet.col_count)
+                for worksheet in self.grown_worksheets.values()
+            ])
+
+
+class SyncBlockWriter(object):
+    """
+    Overwrites a sheet by only sending the cells that differ from its current content.
+    The current values are read by blocks alongside the written rows. Consecutive changed rows
+    are narrowed to the span of their changed columns, and all the spans of a block are sent
+    in a single values.batchUpdate call. Rows left after the last written row are trimmed on close.
+    Cells are compared as they are stored in the sheet: with USER_ENTERED, values that Sheets converts,
+    such as "1.0" stored as 1 or dates, never match and are sent again on each run, so RAW should be used.
+    """
+    def __init__(self, session, worksheet, value_input_option, num_columns, block_size=DSSConstants.WRITE_BLOCK_SIZE):
+        self.session = session
+        self.worksheet = worksheet
+        self.value_input_option = value_input_option
+        if value_input_option == "USER_ENTERED":
+            logger.warning("Sheet is synced with USER_ENTERED, values converted by Google Sheets will be sent on each run")
+        self.num_columns = max(num_columns, 1)
+        self.block_size = block_size
+        self.buffer = []
+        self.next_row = 1
+        self.worksheets_rows = None
+        self.current_rows = None
+        self.changed_rows = 0
+        self.grid_budget = None
+
+    def write_row(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.block_size:
+            self.flush()
+
+    def start(self):
+        if self.worksheet.col_count < self.num_columns:
+            self.session.resize_worksheet(self.worksheet, cols=self.num_columns)
+        self.worksheets_rows = self.session.iter_worksheets_rows(
+            [self.worksheet],
+            window_size=self.block_size,
+            params=CURRENT_VALUES_PARAMS
+        )
+        _, self.current_rows = next(self.worksheets_rows)
+        self.grid_budget = GridBudget(self.session, self.worksheet.spreadsheet)
+
+    def get_changed_ranges(self):
+        changed_ranges = []
+        span = None
+        for row_number, row in enumerate(self.buffer, self.next_row):
+            row = fill_row(row, self.num_columns)
+            current_row = pad_row(next(self.current_rows, []), len(row))
+            changed_columns = [
+                column for column, value in enumerate(row) if cell_to_text(value) != cell_to_text(current_row[column])
+            ]
+            if not changed_columns:
+                span = None
+                continue
+            self.changed_rows += 1
+            if span is None:
+                span = {"first_row": row_number, "first_column": changed_columns[0], "last_column": changed_columns[-1], "rows": []}
+                changed_ranges.append(span)
+            span["first_column"] = min(span["first_column"], changed_columns[0])
+            span["last_column"] = max(span["last_column"], changed_columns[-1])
+            span["rows"].append(row)
+        return [
+            {
+                "range": get_a1_range(
+                    self.worksheet.title,
+                    span["first_row"],
+                    span["first_row"] + len(span["rows"]) - 1,
+                    span["last_column"] + 1,
+                    span["first_column"] + 1
+                ),
+                "values": [row[span["first_column"]:span["last_column"] + 1] for row in span["rows"]]
+            } for span in changed_ranges
+        ]
+
+    def flush(self):
+        if self.current_rows is None:
+            self.start()
+        if not self.buffer:
+            return
+        last_row = self.next_row + len(self.buffer) - 1
+        if last_row > self.worksheet.row_count:
+            rows = self.grid_budget.get_grown_row_count(self.worksheet, last_row, self.worksheet.col_count, self.block_size)
+            self.session.resize_worksheet(self.worksheet, rows=rows)
+        changed_ranges = self.get_changed_ranges()
+        if changed_ranges:
+            self.worksheet.spreadsheet.values_batch_update(
+                body={"valueInputOption": self.value_input_option, "data": changed_ranges}
+            )
+        self.next_row = last_row + 1
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.worksheets_rows.close()
+        written_rows = self.next_row - 1
+        if written_rows == 0:
+            self.session.clear_worksheet(self.worksheet, rows=1, cols=self.num_columns)
+        else:
+            self.session.resize_worksheet(self.worksheet, rows=written_rows, cols=self.num_columns)
+        logger.info("Sheet '{}' synced, {} rows changed out of {}".format(self.worksheet.title, self.changed_rows, written_rows))
+
+
+class UpsertBlockWriter(object):
+    """
+    Updates the rows of a sheet that have the same key as the written rows, and appends the rows with new keys.
+    The header and the key columns of the sheet are read once to index the row number of each key.
+    Updated rows are grouped in ranges of consecutive rows and sent by blocks in values.batchUpdate calls,
+    rows with new keys are appended on close. An empty sheet gets the columns as header.
+    When several rows have the same key, the last one is written. Rows with empty key columns are never
+    matched, like the sheet rows with empty keys, and are all appended.
+    Keys are compared as they are stored in the sheet: with USER_ENTERED, a key that Sheets reinterprets,
+    such as "007" stored as 7, never matches and its row is appended again on each run, so RAW should be used.
+    """
+    def __init__(self, session, worksheet, value_input_option, columns, key_columns, block_size=DSSConstants.WRITE_BLOCK_SIZE):
+        if not key_columns:
+            raise Exception("Key columns must be set to upsert rows")
+        missing_key_columns = [key_column for key_column in key_columns if key_column not in columns]
+        if missing_key_columns:
+            raise Exception("Key columns {} are not in the dataset".format(missing_key_columns))
+        self.session = session
+        self.worksheet = worksheet
+        self.value_input_option = value_input_option
+        self.columns = columns
+        self.key_positions = [columns.index(key_column) for key_column in key_columns]
+        if value_input_option == "USER_ENTERED":
+            logger.warning("Rows are upserted with USER_ENTERED, keys converted by Google Sheets will not be matched")
+        self.block_size = block_size
+        self.index = None
+        self.has_header = False
+        self.updates = {}
+        self.new_rows = []
+        self.new_rows_positions = {}
+        self.updated_rows = 0
+
+    def get_key(self, row):
+        return tuple(cell_to_text(row[position]) if position < len(row) else "" for position in self.key_positions)
+
+    def start(self):
+        self.index = {}
+        first_rows = self.session.get_values(self.worksheet, 1, 1, params=CURRENT_VALUES_PARAMS)
+        header = [cell_to_text(cell) for cell in first_rows[0]] if first_rows else []
+        self.has_header = len(header) > 0
+        if not self.has_header:
+            return
+        if header[:len(self.columns)] != self.columns:
+            raise Exception("The header of sheet '{}' does not match the columns of the dataset".format(self.worksheet.title))
+        if self.worksheet.row_count < 2:
+            return
+        ranges = [
+            get_a1_range(self.worksheet.title, 2, self.worksheet.row_count, position + 1, position + 1)
+            for position in self.key_positions
+        ]
+        params = dict(CURRENT_VALUES_PARAMS, majorDimension="COLUMNS")
+        key_columns = [
+            values[0] if values else [] for values in self.session.batch_get_values(self.worksheet.spreadsheet, ranges, params)
+        ]
+        num_rows = max(len(key_column) for key_column in key_columns)
+        for row_index in range(num_rows):
+            key = tuple(
+                cell_to_text(key_column[row_index]) if row_index < len(key_column) else "" for key_column in key_columns
+            )
+            if any(key):
+                self.index.setdefault(key, row_index + 2)
+        logger.info("{} keys indexed in sheet '{}'".format(len(self.index), self.worksheet.title))
+
+    def write_row(self, row):
+        if self.index is None:
+            self.start()
+        key = self.get_key(row)
+        if not any(key):
+            self.new_rows.append(row)
+            return
+        row_number = self.index.get(key)
+        if row_number is None:
+            position = self.new_rows_positions.setdefault(key, len(self.new_rows))
+            if position == len(self.new_rows):
+                self.new_rows.append(row)
+            else:
+                self.new_rows[position] = row
+            return
+        self.updates[row_number] = row
+        if len(self.updates) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.updates:
+            return
+        spans = []
+        for row_number in sorted(self.updates):
+            if spans and row_number == spans[-1][0] + len(spans[-1][1]):
+                spans[-1][1].append(self.updates[row_number])
+            else:
+                spans.append((row_number, [self.updates[row_number]]))
+        width = len(self.columns)
+        self.worksheet.spreadsheet.values_batch_update(
+            body={
+                "valueInputOption": self.value_input_option,
+                "data": [
+                    {
+                        "range": get_a1_range(self.worksheet.title, first_row, first_row + len(rows) - 1, width),
+                        "values": [fill_row(row, width) for row in rows]
+                    } for first_row, rows in spans
+                ]
+            }
+        )
+        self.updated_rows += len(self.updates)
+        self.updates = {}
+
+    def close(self):
+        if self.index is None:
+            self.start()
+        self.flush()
+        append_writer = AppendBlockWriter(self.worksheet, self.value_input_option, block_size=self.block_size)
+        if not self.has_header:
+            append_writer.write_row(self.columns)
+        for row in self.new_rows:
+            append_writer.write_row(row)
+        append_writer.close()
+        logger.info("Sheet '{}' upserted, {} rows updated and {} rows appended".format(
+            self.worksheet.title, self.updated_rows, len(self.new_rows)
+        ))
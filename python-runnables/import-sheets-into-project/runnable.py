@@ -1,12 +1,21 @@
 import dataiku
+import json
+import hashlib
+import tempfile
+import threading
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 from dataiku.runnables import Runnable, ResultTable
-from googlesheets_common import DSSConstants, extract_credentials, get_unique_slugs, get_unique_names
+from googlesheets_common import DSSConstants, extract_credentials, UniqueNameAllocator, get_unique_names, pad_row, peek_rows_width
 from googlesheets import GoogleSheetsSession
+from googlesheets_concurrency import get_workers_count
 from safe_logger import SafeLogger
 
 
 logger = SafeLogger("googlesheets plugin", ["credentials", "access_token"])
 
+FINGERPRINT_METADATA_KEY = "googlesheets_fingerprint"
+
 
 class GoogleSheetsToDatasetsImporter(Runnable):
     """The base interface for a Python runnable"""
@@ -30,17 +39,30 @@ class GoogleSheetsToDatasetsImporter(Runnable):
         self.project = dss_client.get_project(project_key)
         self.project_datasets = list_project_datasets_names(self.project)
         self.creation_mode = self.config.get("creation_mode", "create-new")
+        self.read_workers = self.config.get("read_workers", 1)
+        self.import_workers = self.config.get("import_workers", 4)
         self.worksheets = self.session.get_spreadsheets(self.doc_id)
         if not self.tabs_ids:
             for worksheet in self.worksheets:
                 self.tabs_ids.append(worksheet.title)
+        self.selected_worksheets = [worksheet for worksheet in self.worksheets if worksheet.title in self.tabs_ids]
+        self.last_data_rows = None
+        self.progress_lock = threading.Lock()
+        self.imported_records = 0
+        self.last_modified = None
+
+    def get_last_data_rows(self):
+        if self.last_data_rows is None:
+            self.last_data_rows = self.session.get_last_data_rows(self.selected_worksheets)
+        return self.last_data_rows
 
     def get_progress_target(self):
         """
         If the runnable will return some progress info, have this function return a tuple of 
         (target, unit) where unit is one of: SIZE, FILES, RECORDS, NONE
         """
-        return (len(self.tabs_ids), 'FILES')
+        # The first row of each sheet is its header
+        return (sum(max(0, last_data_row - 1) for last_data_row in self.get_last_data_rows()), 'RECORDS')
 
     def run(self, progress_callback):
         """
@@ -61,64 +83,136 @@ class GoogleSheetsToDatasetsImporter(Runnable):
             if not self.is_dry_run:
                 target_zone = project_flow.create_zone(spreadsheet_title)
 
+        dataset_names = UniqueNameAllocator()
         if self.creation_mode == "create-new":
-            worksheets_titles = self.project_datasets.copy()
-        else:
-            worksheets_titles = []
-        index = 0
-        for worksheet in self.worksheets:
+            dataset_names.allocate_all(self.project_datasets)
+        # Datasets are planned one after the other, then the sheets are streamed into them in parallel
+        imports = []
+        self.last_modified = self.session.get_last_modified(self.doc_id)
+        for worksheet, last_data_row in zip(self.selected_worksheets, self.get_last_data_rows()):
             worksheet_title = worksheet.title
-            if worksheet_title in self.tabs_ids:
-                index += 1
-                progress_callback(index)
-                dataset = None
-                worksheets_titles.append("{}_{}".format(spreadsheet_title, worksheet_title))
-                worksheets_titles = get_unique_slugs(worksheets_titles)
-                unique_worksheet_title = worksheets_titles[-1]
-
-                rows = []
-                if not self.is_dry_run:
-                    rows = worksheet.get_all_values()
-                if not rows:
+            dataset = None
+            unique_worksheet_title = dataset_names.allocate("{}_{}".format(spreadsheet_title, worksheet_title))
+
+            if last_data_row == 0:
+                continue
+            dataset_title = unique_worksheet_title
+            if dataset_title in self.project_datasets:
+                if self.creation_mode == "skip":
+                    result_table.add_record([self._get_text("skipping").format(dataset_title=dataset_title)])
+                    self.report_progress(max(0, last_data_row - 1), progress_callback)
+                    continue
+                dataset = self.project.get_dataset(dataset_title)
+                stored_fingerprint = get_dataset_fingerprint(dataset)
+                if is_same_revision(stored_fingerprint, self.get_worksheet_fingerprint(worksheet)):
+                    # The document was not modified since the last import
+                    result_table.add_record([self._get_text("unchanged").format(dataset_title=dataset_title)])
+                    self.report_progress(max(0, last_data_row - 1), progress_callback)
                     continue
-                dataset_title = unique_worksheet_title
-                if dataset_title in self.project_datasets:
-                    if self.creation_mode == "skip":
-                        result_table.add_record([self._get_text("skipping").format(dataset_title=dataset_title)])
-                        continue
-                    result_table.add_record([self._get_text("updating").format(dataset_title=dataset_title)])
-                    if not self.is_dry_run:
-                        dataset = self.project.get_dataset(dataset_title)
-                else:
-                    params = {
-                        "connection": "filesystem_folders",
-                        "path": "{}/{}".format(self.project_key, dataset_title)
-                    }
-                    result_table.add_record([self._get_text("adding").format(dataset_title=dataset_title)])
-                    if not self.is_dry_run:
-                        dataset = self.project.create_dataset(
-                            dataset_title, "Filesystem", params=params, formatType='csv',
-                            formatParams=DSSConstants.DEFAULT_DATASET_FORMAT
-                        )
-                    if target_zone and dataset:
-                        dataset.move_to_zone(target_zone)
+                result_table.add_record([self._get_text("updating").format(dataset_title=dataset_title)])
+            else:
+                params = {
+                    "connection": "filesystem_folders",
+                    "path": "{}/{}".format(self.project_key, dataset_title)
+                }
+                result_table.add_record([self._get_text("adding").format(dataset_title=dataset_title)])
                 if not self.is_dry_run:
-                    set_dataset_as_managed(dataset)
-                    output_dataset = dataiku.Dataset(dataset_title)
-                    column_names = get_unique_names(rows[0])
-                    schema = []
-                    for column_name in column_names:
-                        schema.append({"name": column_name, "type": "string"})
-                    output_dataset.write_schema(schema)
-                    data_rows = rows[1:]
-                    if not self.is_dry_run:
-                        with output_dataset.get_writer() as writer:
-                            for row in data_rows:
-                                writer.write_row_array(row)
+                    dataset = self.project.create_dataset(
+                        dataset_title, "Filesystem", params=params, formatType='csv',
+                        formatParams=DSSConstants.DEFAULT_DATASET_FORMAT
+                    )
+                if target_zone and dataset:
+                    dataset.move_to_zone(target_zone)
+            if not self.is_dry_run:
+                set_dataset_as_managed(dataset)
+                imports.append((worksheet, dataset, dataset_title))
+            else:
+                self.report_progress(max(0, last_data_row - 1), progress_callback)
+
+        if imports:
+            with ThreadPoolExecutor(max_workers=get_workers_count(self.import_workers)) as executor:
+                futures = [
+                    executor.submit(self.import_worksheet, worksheet, dataset, dataset_title, progress_callback)
+                    for worksheet, dataset, dataset_title in imports
+                ]
+                for (worksheet, dataset, dataset_title), future in zip(imports, futures):
+                    if not future.result():
+                        result_table.add_record([self._get_text("same_values").format(dataset_title=dataset_title)])
         if self.is_dry_run:
             result_table.add_record(["⚠️ You have to un-check the 'Dry run' box to implement these actions."])
         return result_table
 
+    def get_worksheet_fingerprint(self, worksheet):
+        return {
+            "doc_id": self.doc_id,
+            "sheet_id": worksheet.id,
+            "modified_time": self.last_modified,
+            "grid": [worksheet.row_count, worksheet.col_count]
+        }
+
+    def import_worksheet(self, worksheet, dataset, dataset_title, progress_callback):
+        """
+        Streams the rows of a sheet into its dataset, window by window, and stores the fingerprint of its values
+        in the dataset metadata. Returns False if the dataset was left untouched because its values did not change.
+        """
+        fingerprint = self.get_worksheet_fingerprint(worksheet)
+        stored_fingerprint = get_dataset_fingerprint(dataset)
+        for worksheet, rows in self.session.iter_worksheets_rows([worksheet], workers=self.read_workers):
+            # Like get_all_values used to, the header is padded to the used width of the sheet
+            first_rows, width, has_more_rows = peek_rows_width(rows, DSSConstants.READ_WINDOW_SIZE)
+            if not first_rows:
+                return True
+            if has_more_rows:
+                width = self.session.get_used_width(worksheet, width, first_row=len(first_rows) + 1)
+            first_row = pad_row(list(first_rows[0]), width)
+            rows = chain(first_rows[1:], rows)
+            values_hash = hashlib.sha256()
+            update_values_hash(values_hash, first_row)
+            if is_same_sheet(stored_fingerprint, fingerprint):
+                # Only the values can tell whether the sheet changed, so they are spooled to disk
+                # while being hashed, and written to the dataset only if the hash differs
+                with tempfile.TemporaryFile(mode="w+", encoding="utf-8") as spool:
+                    records = 0
+                    for row in rows:
+                        spool.write(update_values_hash(values_hash, row))
+                        records += 1
+                    fingerprint["values_hash"] = values_hash.hexdigest()
+                    if fingerprint["values_hash"] == stored_fingerprint.get("values_hash"):
+                        set_dataset_fingerprint(dataset, fingerprint)
+                        self.report_progress(records, progress_callback)
+                        return False
+                    spool.seek(0)
+                    self.write_dataset(dataset_title, first_row, (json.loads(line) for line in spool), progress_callback)
+            else:
+                self.write_dataset(dataset_title, first_row, rows, progress_callback, values_hash)
+                fingerprint["values_hash"] = values_hash.hexdigest()
+            set_dataset_fingerprint(dataset, fingerprint)
+        return True
+
+    def write_dataset(self, dataset_title, first_row, rows, progress_callback, values_hash=None):
+        output_dataset = dataiku.Dataset(dataset_title)
+        column_names = get_unique_names(first_row)
+        schema = []
+        for column_name in column_names:
+            schema.append({"name": column_name, "type": "string"})
+        output_dataset.write_schema(schema)
+        records = 0
+        with output_dataset.get_writer() as writer:
+            for row in rows:
+                if values_hash is not None:
+                    update_values_hash(values_hash, row)
+                writer.write_row_array(pad_row(row, len(column_names)))
+                records += 1
+                if records == DSSConstants.PROGRESS_REPORT_RECORDS:
+                    self.report_progress(records, progress_callback)
+                    records = 0
+        self.report_progress(records, progress_callback)
+
+    def report_progress(self, records, progress_callback):
+        with self.progress_lock:
+            self.imported_records += records
+            progress_callback(self.imported_records)
+
     def _get_text(self, text_description):
         DRY_RUN_TEXTS = {
             "actions": "Actions to be taken",
@@ -126,6 +220,7 @@ class GoogleSheetsToDatasetsImporter(Runnable):
             "adding": "Would add a '{dataset_title}' dataset to the flow",
             "skipping": "Would skip the existing '{dataset_title}' dataset",
             "updating": "Would update the existing '{dataset_title}' dataset",
+            "unchanged": "Would skip the existing '{dataset_title}' dataset, its sheet was not modified since the last import",
         }
         RUN_TEXTS = {
             "actions": "Actions",
@@ -133,6 +228,8 @@ class GoogleSheetsToDatasetsImporter(Runnable):
             "adding": "Adding a '{dataset_title}' dataset to the flow",
             "skipping": "Skipping the existing '{dataset_title}' dataset",
             "updating": "Updating the existing '{dataset_title}' dataset",
+            "unchanged": "Skipping the existing '{dataset_title}' dataset, its sheet was not modified since the last import",
+            "same_values": "Left the existing '{dataset_title}' dataset untouched, the values of its sheet did not change",
         }
         if self.is_dry_run:
             ret = DRY_RUN_TEXTS.get(text_description, "Empty")
@@ -163,3 +260,32 @@ def set_dataset_as_managed(dataset):
     dataset_definition = dataset.get_definition()
     dataset_definition["managed"] = True
     dataset.set_definition(dataset_definition)
+
+
+def update_values_hash(values_hash, row):
+    line = json.dumps(row) + "\n"
+    values_hash.update(line.encode("utf-8"))
+    return line
+
+
+def get_dataset_fingerprint(dataset):
+    if dataset is None:
+        return None
+    return dataset.get_metadata().get("custom", {}).get("kv", {}).get(FINGERPRINT_METADATA_KEY)
+
+
+def set_dataset_fingerprint(dataset, fingerprint):
+    metadata = dataset.get_metadata()
+    metadata.setdefault("custom", {}).setdefault("kv", {})[FINGERPRINT_METADATA_KEY] = fingerprint
+    dataset.set_metadata(metadata)
+
+
+def is_same_sheet(stored_fingerprint, fingerprint):
+    if not stored_fingerprint:
+        return False
+    return all(stored_fingerprint.get(key) == fingerprint.get(key) for key in ["doc_id", "sheet_id", "grid"])
+
+
+def is_same_revision(stored_fingerprint, fingerprint):
+    return is_same_sheet(stored_fingerprint, fingerprint) and fingerprint.get("modified_time") is not None \
+        and stored_fingerprint.get("modified_time") == fingerprint.get("modified_time")
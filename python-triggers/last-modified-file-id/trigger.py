@@ -3,6 +3,7 @@ from dataiku.customtrigger import get_plugin_config
 from dataiku.customtrigger import get_trigger_config
 from dataiku.scenario import Trigger
 from dku_googledrive.session import GoogleDriveSession
+from dku_googledrive.googledrive_utils import GoogleDriveUtils as gdu
 from dataiku import Dataset, default_project_key, Project
 from datetime import datetime
 import time
@@ -23,38 +24,104 @@ project = Project()
 project_variables = project.get_variables()
 prefix = config.get("prefix", "googlesheets_trigger_")
 
-google_sheet_file_id = config.get("google_sheets_file_id")
-if google_sheet_file_id is None:
-    logger.error("File ID is empty")
-    raise Exception("File ID cannot be left empty")
-
-project_variable_name = "{}_{}".format(prefix, google_sheet_file_id)
-last_modified = project_variables.get("standard", {}).get(project_variable_name, 0)
-
+watch_mode = config.get("watch_mode", "file")
 plugin_config = plugin_config.get("pluginConfig", {})
 session = GoogleDriveSession(config, plugin_config)
 
-remote_file_last_modified = session.get_last_modified_by_file_id(google_sheet_file_id)
-remote_file_last_modified_epoch = 0
-try:
-    remote_file_last_modified_epoch = int(datetime.strptime(remote_file_last_modified, "%Y-%m-%dT%H:%M:%S.%f%z").timestamp()) * 1000
-except Exception as error_message:
-    logger.error("Could not convert remote file last modified date: {}. Error {}".format(
-            remote_file_last_modified,
-            error_message
+
+def check_file():
+    google_sheet_file_id = config.get("google_sheets_file_id")
+    if not google_sheet_file_id:
+        logger.error("File ID is empty")
+        raise Exception("File ID cannot be left empty")
+
+    project_variable_name = "{}_{}".format(prefix, google_sheet_file_id)
+    last_modified = project_variables.get("standard", {}).get(project_variable_name, 0)
+
+    remote_file_last_modified = session.get_last_modified_by_file_id(google_sheet_file_id)
+    remote_file_last_modified_epoch = 0
+    try:
+        remote_file_last_modified_epoch = int(datetime.strptime(remote_file_last_modified, "%Y-%m-%dT%H:%M:%S.%f%z").timestamp()) * 1000
+    except Exception as error_message:
+        logger.error("Could not convert remote file last modified date: {}. Error {}".format(
+                remote_file_last_modified,
+                error_message
+            )
         )
-    )
-
-local_last_modified_pretty = time.strftime('%Y-%m-%d %H:%M:%S%z', time.gmtime(last_modified/1000))
-remote_last_modified_pretty = time.strftime('%Y-%m-%d %H:%M:%S%z', time.gmtime(remote_file_last_modified_epoch/1000))
-
-logger.info("Trigger.{}.lastLocalTime: {} ({}) versus remoteTime: {} ({})".format(project_variable_name, last_modified, local_last_modified_pretty, remote_file_last_modified_epoch, remote_last_modified_pretty))
-if remote_file_last_modified_epoch > last_modified:
-    logger.info("remote epoch {} > local epoch {}, firing the trigger".format(remote_file_last_modified_epoch, last_modified))
-    remote_file_last_modified_epoch = int(time.time()) * 1000
-    project_variables["standard"][project_variable_name] = remote_file_last_modified_epoch
-    project.set_variables(project_variables)
-    trigger.fire()
+
+    local_last_modified_pretty = time.strftime('%Y-%m-%d %H:%M:%S%z', time.gmtime(last_modified/1000))
+    remote_last_modified_pretty = time.strftime('%Y-%m-%d %H:%M:%S%z', time.gmtime(remote_file_last_modified_epoch/1000))
+
+    logger.info("Trigger.{}.lastLocalTime: {} ({}) versus remoteTime: {} ({})".format(project_variable_name, last_modified, local_last_modified_pretty, remote_file_last_modified_epoch, remote_last_modified_pretty))
+    if remote_file_last_modified_epoch > last_modified:
+        logger.info("remote epoch {} > local epoch {}, firing the trigger".format(remote_file_last_modified_epoch, last_modified))
+        remote_file_last_modified_epoch = int(time.time()) * 1000
+        project_variables["standard"][project_variable_name] = remote_file_last_modified_epoch
+        project.set_variables(project_variables)
+        trigger.fire()
+    else:
+        logger.info("Remote spreadsheet has not been modified")
+
+
+def get_configured_file_ids():
+    if watch_mode == "folder":
+        folder_id = (config.get("folder_id") or "").strip()
+        if not folder_id:
+            raise Exception("Folder ID cannot be left empty")
+        return folder_id, None
+    file_ids = [file_id.strip() for file_id in config.get("google_sheets_file_ids") or [] if file_id and file_id.strip()]
+    if not file_ids:
+        raise Exception("The list of file IDs cannot be left empty")
+    return None, file_ids
+
+
+def is_watched(change, folder_id, file_ids):
+    file = change.get("file", {})
+    if change.get("removed") or file.get("trashed") or file.get(gdu.MIME_TYPE) == gdu.FOLDER:
+        return False
+    if folder_id:
+        return folder_id in file.get(gdu.PARENTS, [])
+    return change.get("fileId") in file_ids
+
+
+def check_changes():
+    """
+    Polls the Drive changes feed from the page token stored by the previous run,
+    so that all the watched files are checked with a single call
+    """
+    page_token_variable_name = "{}_page_token".format(prefix)
+    changed_files_variable_name = "{}_changed_file_ids".format(prefix)
+    page_token = project_variables.get("standard", {}).get(page_token_variable_name)
+    folder_id, file_ids = get_configured_file_ids()
+    if page_token:
+        changes, new_page_token = session.list_changes(page_token)
+        changed_file_ids = []
+        for change in changes:
+            if is_watched(change, folder_id, file_ids) and change.get("fileId") not in changed_file_ids:
+                changed_file_ids.append(change.get("fileId"))
+        logger.info("Trigger.{}: {} changes since page token {}, {} on watched files".format(
+            prefix, len(changes), page_token, len(changed_file_ids)
+        ))
+    else:
+        # Like the single file mode, the first run fires for all the watched files
+        new_page_token = session.get_changes_start_page_token()
+        changed_file_ids = file_ids
+        if folder_id:
+            files = session.googledrive_list(gdu.query_parents_in([folder_id], trashed=False))
+            changed_file_ids = [gdu.get_id(file) for file in files if not gdu.is_directory(file)]
+        logger.info("Trigger.{}: no page token yet, starting from {}".format(prefix, new_page_token))
+    project_variables["standard"][page_token_variable_name] = new_page_token
+    if changed_file_ids:
+        logger.info("Files {} were modified, firing the trigger".format(changed_file_ids))
+        project_variables["standard"][changed_files_variable_name] = changed_file_ids
+        project.set_variables(project_variables)
+        trigger.fire()
+    else:
+        project.set_variables(project_variables)
+        logger.info("Remote spreadsheets have not been modified")
+
+
+if watch_mode == "file":
+    check_file()
 else:
-    logger.info("Remote spreadsheet has not been modified")
-    
+    check_changes()
@@ -0,0 +1,113 @@
+import random
+import pytest
+from slugify import slugify
+from googlesheets_common import (
+    DSSConstants, UniqueNameAllocator, format_date, format_dss_date, convert_dates_in_row, get_unique_slugs, get_unique_names
+)
+
+
+def reference_format_dss_date(date):
+    # Conversion used before format_dss_date, which must give the same results
+    return format_date(date, DSSConstants.DSS_DATE_FORMAT, DSSConstants.GSPREAD_DATE_FORMAT)
+
+
+def get_outcome(function, date):
+    try:
+        return "value", function(date)
+    except Exception as error:
+        return "error", type(error)
+
+
+def generate_fuzzed_date(generator):
+    year = generator.choice(["2024", "2023", "1900", "2000", "2100", "1999", "0999", "0001", "9999", "999", "20240"])
+    month = generator.choice(["01", "02", "04", "06", "09", "11", "12", "00", "13", "1", "7"])
+    day = generator.choice(["01", "09", "10", "28", "29", "30", "31", "32", "00", "1"])
+    hour = generator.choice(["00", "09", "12", "23", "24", "1"])
+    minute = generator.choice(["00", "30", "59", "60", "5"])
+    second = generator.choice(["00", "30", "59", "60", "61", "5"])
+    fraction = "".join(generator.choice("0123456789") for _ in range(generator.randint(0, 7)))
+    separator = generator.choice(["T", "T", "T", " ", "t"])
+    suffix = generator.choice(["Z", "Z", "Z", "", "z", "+00:00", "Z "])
+    date = "{}-{}-{}{}{}:{}:{}".format(year, month, day, separator, hour, minute, second)
+    if fraction or generator.random() < 0.8:
+        date += "." + fraction
+    return date + suffix
+
+
+def test_format_dss_date_formats_well_formed_dates():
+    assert format_dss_date("2024-02-29T23:59:58.123Z") == "2024-02-29 23:59:58"
+    assert format_dss_date("2021-12-01T00:00:00.000000Z") == "2021-12-01 00:00:00"
+
+
+@pytest.mark.parametrize("date", [None, "", "2023-02-29T00:00:00.000Z", "2024-04-31T00:00:00.000Z", "0999-01-01T00:00:00.000Z", "2024-01-01"])
+def test_format_dss_date_edge_cases_match_reference(date):
+    assert get_outcome(format_dss_date, date) == get_outcome(reference_format_dss_date, date)
+
+
+def test_format_dss_date_matches_reference_on_fuzzed_dates():
+    generator = random.Random(12)
+    mismatches = []
+    for _ in range(50000):
+        date = generate_fuzzed_date(generator)
+        if get_outcome(format_dss_date, date) != get_outcome(reference_format_dss_date, date):
+            mismatches.append(date)
+    assert mismatches == []
+
+
+def test_convert_dates_in_row_only_converts_date_columns():
+    row = ["2024-01-02T03:04:05.678Z", "2024-01-02T03:04:05.678Z", None]
+    assert convert_dates_in_row(row, [0, 2]) == ["2024-01-02 03:04:05", "2024-01-02T03:04:05.678Z", None]
+
+
+def reference_get_unique_names(list_of_names, slugify_names=True, max_length=0):
+    # List based allocation used before UniqueNameAllocator, which must give the same results
+    list_unique_names = []
+    for name in list_of_names:
+        base_name = slugify(name, max_length=max_length, separator="_", lowercase=False) if slugify_names else name
+        if base_name == '':
+            base_name = 'none'
+        test_string = base_name
+        i = 0
+        while test_string in list_unique_names:
+            i += 1
+            test_string = base_name + '_' + str(i)
+        list_unique_names.append(test_string)
+    return list_unique_names
+
+
+NAME_PARTS = ["a", "b", "a_1", "_1", "_2", "", " ", "é", "-", "Col", "col", "x" * 30, "_", "1", "a-b", "none", "none_1"]
+
+
+def generate_fuzzed_names(generator):
+    return [
+        "".join(generator.choice(NAME_PARTS) for _ in range(generator.randint(0, 3)))
+        for _ in range(generator.randint(0, 40))
+    ]
+
+
+def test_unique_name_allocator_suffixes_duplicates():
+    assert get_unique_slugs(["a b", "a-b", "", "", "a_b_1", "a b"]) == ["a_b", "a_b_1", "none", "none_1", "a_b_1_1", "a_b_2"]
+    assert get_unique_names(["a", "a", "a_1", ""]) == ["a", "a_1", "a_1_1", "none"]
+
+
+def test_unique_name_allocator_matches_reference_on_fuzzed_names():
+    generator = random.Random(24)
+    for _ in range(5000):
+        names = generate_fuzzed_names(generator)
+        assert get_unique_slugs(names) == reference_get_unique_names(names), names
+        assert get_unique_names(names) == reference_get_unique_names(names, slugify_names=False), names
+        assert UniqueNameAllocator(max_length=25).allocate_all(names) == reference_get_unique_names(names, max_length=25), names
+
+
+def test_unique_name_allocator_matches_reference_incrementally():
+    # The import macro used to slugify the whole growing list of names for each new dataset
+    existing_names = ["ds_{}".format(index % 70) for index in range(100)] + ["Doc_Sheet_1", "Doc_Sheet_1_1"]
+    new_names = ["Doc_Sheet {}".format(index % 7) for index in range(40)]
+    names = list(existing_names)
+    reference_names = []
+    for new_name in new_names:
+        names.append(new_name)
+        reference_names.append(reference_get_unique_names(names)[-1])
+    allocator = UniqueNameAllocator()
+    allocator.allocate_all(existing_names)
+    assert [allocator.allocate(new_name) for new_name in new_names] == reference_names
@@ -0,0 +1,247 @@
+from datetime import datetime
+from gspread.utils import a1_to_rowcol
+from googlesheets_write import GridBudget, MultiSheetBlockWriter, SyncBlockWriter, UpsertBlockWriter
+
+
+class FakeSpreadsheet(object):
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self.calls = []
+        self.sent_ranges = []
+
+    def values_batch_update(self, params=None, body=None):
+        self.calls.append("values_batch_update")
+        self.sent_ranges.extend(body["data"])
+        for value_range in body["data"]:
+            self.worksheet.set_values(value_range["range"], value_range["values"], body["valueInputOption"])
+
+    def values_append(self, title, params, body):
+        self.calls.append("values_append")
+        first_row = len(self.worksheet.rows) + 1
+        self.worksheet.set_values("'{}'!A{}".format(title, first_row), body["values"], params["valueInputOption"])
+
+
+class FakeWorksheet(object):
+    """
+    Sheet kept in memory, whose cells are stored like the Sheets API would store them
+    """
+    def __init__(self, rows, row_count=None, col_count=None):
+        self.title = "Sheet"
+        self.id = 1
+        self.rows = [list(row) for row in rows]
+        self.row_count = row_count or max(len(self.rows), 1)
+        self.col_count = col_count or max([len(row) for row in self.rows] + [1])
+        self.spreadsheet = FakeSpreadsheet(self)
+
+    def set_values(self, a1_range, values, value_input_option):
+        first_row, first_column = a1_to_rowcol(a1_range.split("!")[1].split(":")[0])
+        for row_offset, row in enumerate(values):
+            row_index = first_row - 1 + row_offset
+            while len(self.rows) <= row_index:
+                self.rows.append([])
+            sheet_row = self.rows[row_index]
+            for column_offset, value in enumerate(row):
+                if value is None:
+                    # The API leaves the cells sent as null untouched
+                    continue
+                column_index = first_column - 1 + column_offset
+                while len(sheet_row) <= column_index:
+                    sheet_row.append("")
+                sheet_row[column_index] = store_value(value, value_input_option)
+        self.row_count = max(self.row_count, len(self.rows))
+
+    def get_values(self):
+        # Like the API, trailing empty cells and rows are dropped
+        rows = []
+        for row in self.rows:
+            row = list(row)
+            while row and row[-1] == "":
+                row.pop()
+            rows.append(row)
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+
+def store_value(value, value_input_option):
+    if value_input_option == "USER_ENTERED" and isinstance(value, str):
+        # USER_ENTERED text is parsed, numbers are stored as numbers and dates are read back
+        # formatted with the locale of the spreadsheet
+        try:
+            date = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+            return "{}/{}/{} {}:{:02d}:{:02d}".format(date.month, date.day, date.year, date.hour, date.minute, date.second)
+        except ValueError:
+            pass
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+        return int(number) if number.is_integer() else number
+    return value
+
+
+class FakeSession(object):
+    def __init__(self, worksheets_cells=None):
+        self.worksheets_cells = worksheets_cells or {}
+
+    def get_worksheets_cells(self, spreadsheet):
+        return dict(self.worksheets_cells)
+
+    def resize_worksheet(self, worksheet, rows=None, cols=None):
+        if rows is not None:
+            worksheet.row_count = rows
+            del worksheet.rows[rows:]
+        if cols is not None:
+            worksheet.col_count = cols
+            worksheet.rows = [row[:cols] for row in worksheet.rows]
+
+    def resize_worksheets(self, spreadsheet, sizes):
+        for worksheet, rows, cols in sizes:
+            worksheet.row_count = rows
+            worksheet.col_count = cols
+
+    def clear_worksheet(self, worksheet, rows=None, cols=None):
+        worksheet.rows = []
+        self.resize_worksheet(worksheet, rows, cols)
+
+    def iter_worksheets_rows(self, worksheets, window_size=None, max_rows=None, workers=1, params=None):
+        for worksheet in worksheets:
+            yield worksheet, iter(worksheet.get_values())
+
+    def get_values(self, worksheet, first_row, last_row, params=None):
+        return worksheet.get_values()[first_row - 1:last_row]
+
+    def batch_get_values(self, spreadsheet, ranges, params=None):
+        rows = spreadsheet.worksheet.get_values()
+        columns = []
+        for a1_range in ranges:
+            first_row, column = a1_to_rowcol(a1_range.split("!")[1].split(":")[0])
+            column_values = [row[column - 1] if column - 1 < len(row) else "" for row in rows[first_row - 1:]]
+            while column_values and column_values[-1] == "":
+                column_values.pop()
+            columns.append([column_values] if column_values else [])
+        return columns
+
+
+def upsert(worksheet, rows, columns=["id", "value"], key_columns=["id"]):
+    writer = UpsertBlockWriter(FakeSession(), worksheet, "RAW", columns, key_columns)
+    for row in rows:
+        writer.write_row(row)
+    writer.close()
+    return worksheet.get_values()
+
+
+def test_upsert_updates_existing_keys_and_appends_new_ones():
+    worksheet = FakeWorksheet([["id", "value"], ["1", "a"], ["2", "b"]])
+    rows = upsert(worksheet, [["2", "B"], ["3", "c"]])
+    assert rows == [["id", "value"], ["1", "a"], ["2", "B"], ["3", "c"]]
+
+
+def test_upsert_clears_emptied_fields():
+    worksheet = FakeWorksheet([["id", "value"], ["1", "a"]])
+    assert upsert(worksheet, [["1", None]]) == [["id", "value"], ["1"]]
+
+
+def test_upsert_appends_all_rows_with_empty_keys():
+    worksheet = FakeWorksheet([["id", "value"], ["", "sheet row"]])
+    rows = upsert(worksheet, [[None, "n1"], ["", "n2"]])
+    assert rows == [["id", "value"], ["", "sheet row"], ["", "n1"], ["", "n2"]]
+
+
+def test_upsert_keeps_the_last_row_of_duplicate_keys():
+    worksheet = FakeWorksheet([["id", "value"], ["1", "a"]])
+    rows = upsert(worksheet, [["1", "x"], ["2", "first"], ["1", "y"], ["3", "c"], ["2", "last"]])
+    assert rows == [["id", "value"], ["1", "y"], ["2", "last"], ["3", "c"]]
+
+
+def test_upsert_writes_the_header_of_an_empty_sheet():
+    worksheet = FakeWorksheet([])
+    assert upsert(worksheet, [["1", "a"]]) == [["id", "value"], ["1", "a"]]
+
+
+def test_grid_budget_grows_grids_geometrically_by_a_few_blocks():
+    worksheet = FakeWorksheet([], row_count=1000, col_count=26)
+    grid_budget = GridBudget(FakeSession({1: 1000 * 26}), worksheet.spreadsheet)
+    assert grid_budget.get_grown_row_count(worksheet, 1500, 26, 2000) == 2000
+    worksheet.row_count = 256000
+    assert grid_budget.get_grown_row_count(worksheet, 258000, 26, 2000) == 258000 + 4 * 2000
+
+
+def test_grid_budget_keeps_the_spreadsheet_under_the_cells_limit():
+    worksheet = FakeWorksheet([], row_count=200000, col_count=26)
+    grid_budget = GridBudget(FakeSession({1: 200000 * 26, 2: 2000000}), worksheet.spreadsheet)
+    assert grid_budget.get_grown_row_count(worksheet, 300000, 26, 50000) == (10000000 - 2000000) // 26
+    # Rows that do not fit are still requested, so that the API reports the error
+    assert grid_budget.get_grown_row_count(worksheet, 400000, 26, 50000) == 400000
+
+
+def test_multisheet_grids_grow_within_a_shared_cells_limit():
+    first_worksheet = FakeWorksheet([], row_count=100000, col_count=26)
+    second_worksheet = FakeWorksheet([], row_count=100000, col_count=26)
+    second_worksheet.id = 2
+    second_worksheet.title = "Other"
+    session = FakeSession({1: 100000 * 26, 2: 100000 * 26, 3: 1000 * 26})
+    writer = MultiSheetBlockWriter(session, first_worksheet.spreadsheet, "RAW", {1: 100001, 2: 100001}, block_size=100000)
+    writer.write_row(first_worksheet, ["a"])
+    writer.write_row(second_worksheet, ["b"])
+    writer.flush()
+    # Doubling both grids would need 10.426M cells, the second one only gets the cells left by the first one
+    assert first_worksheet.row_count == 200000
+    assert second_worksheet.row_count == (10000000 - 200000 * 26 - 1000 * 26) // 26
+    writer.close()
+    assert (first_worksheet.row_count, second_worksheet.row_count) == (100001, 100001)
+
+
+def sync(worksheet, rows, value_input_option="RAW"):
+    writer = SyncBlockWriter(FakeSession(), worksheet, value_input_option, 2, block_size=2)
+    worksheet.spreadsheet.sent_ranges = []
+    for row in rows:
+        writer.write_row(row)
+    writer.close()
+    return worksheet.spreadsheet.sent_ranges
+
+
+def test_sync_only_sends_the_changed_cells():
+    worksheet = FakeWorksheet([["id", "value"], ["1", "a"], ["2", "b"], ["3", "c"]])
+    sent_ranges = sync(worksheet, [["id", "value"], ["1", "a"], ["2", "B"], ["3", "c"]])
+    assert sent_ranges == [{"range": "'Sheet'!B3:B3", "values": [["B"]]}]
+
+
+def test_sync_sends_emptied_cells_as_empty_strings():
+    worksheet = FakeWorksheet([["id", "value"], ["1", "a"]])
+    sent_ranges = sync(worksheet, [["id", "value"], ["1", None]])
+    # A null cell would be left untouched by the API
+    assert sent_ranges == [{"range": "'Sheet'!B2:B2", "values": [[""]]}]
+    assert worksheet.get_values() == [["id", "value"], ["1"]]
+
+
+def test_sync_grows_the_grid():
+    worksheet = FakeWorksheet([["id"]], row_count=1, col_count=1)
+    rows = [["id", "value"], ["1", "a"], ["2", "b"], ["3", "c"], ["4", "d"]]
+    sync(worksheet, rows)
+    assert worksheet.get_values() == rows
+    assert (worksheet.row_count, worksheet.col_count) == (5, 2)
+
+
+def test_sync_trims_the_grid_to_the_written_rows():
+    worksheet = FakeWorksheet([["id", "value"], ["1", "a"], ["2", "b"], ["3", "c"]], row_count=1000)
+    assert sync(worksheet, [["id", "value"], ["1", "a"]]) == []
+    assert worksheet.get_values() == [["id", "value"], ["1", "a"]]
+    assert worksheet.row_count == 2
+
+
+def test_sync_converges_with_raw_values():
+    worksheet = FakeWorksheet([])
+    rows = [["id", "value"], ["1.0", "2024-01-02 03:04:05"]]
+    assert sync(worksheet, rows) != []
+    assert sync(worksheet, rows) == []
+
+
+def test_sync_resends_the_values_converted_by_user_entered_on_each_run():
+    worksheet = FakeWorksheet([])
+    rows = [["id", "value"], ["1.0", "2024-01-02 03:04:05"]]
+    sync(worksheet, rows, "USER_ENTERED")
+    assert worksheet.get_values() == [["id", "value"], [1, "1/2/2024 3:04:05"]]
+    for _ in range(2):
+        sent_ranges = sync(worksheet, rows, "USER_ENTERED")
+        assert sent_ranges == [{"range": "'Sheet'!A2:B2", "values": [["1.0", "2024-01-02 03:04:05"]]}]